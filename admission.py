@@ -0,0 +1,80 @@
+import socket
+from collections import OrderedDict
+from time import monotonic
+from constants import (CLIENT_PREFIX_V4, CLIENT_PREFIX_V6, RATE_LIMIT_MAX_ENTRIES,
+                       RRL_SLIP)
+
+# what response rate limiting does with response
+SEND, SLIP, DROP = range(3)
+
+
+# network of client address, clients of same /24 (/56 for ipv6) share limits
+def client_prefix(ip, prefix_v4=CLIENT_PREFIX_V4, prefix_v6=CLIENT_PREFIX_V6):
+    if ':' in ip:
+        packed = socket.inet_pton(socket.AF_INET6, ip.split('%')[0])
+        return 6, int.from_bytes(packed, 'big') >> (128 - prefix_v6)
+    return 4, int.from_bytes(socket.inet_aton(ip), 'big') >> (32 - prefix_v4)
+
+
+# token bucket per key: rate tokens per second, at most burst kept
+# least recently used keys are forgotten above max_entries
+# used from event loop thread only, no lock
+class TokenBuckets():
+
+    def __init__(self, rate, burst=None, max_entries=RATE_LIMIT_MAX_ENTRIES):
+        self.rate = rate
+        self.burst = max(1, burst or rate)
+        self.max_entries = max_entries
+        self.buckets = OrderedDict()  # key: [tokens, last refill, limited in row]
+
+    # takes token of key, returns 0 if there was one, otherwise how many
+    # times in row key was limited
+    def limited(self, key, now=None):
+        now = monotonic() if now is None else now
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now, 0]
+            if len(self.buckets) > self.max_entries:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            bucket[2] = 0
+            return 0
+        bucket[2] += 1
+        return bucket[2]
+
+    def __len__(self):
+        return len(self.buckets)
+
+
+# queries per second of one client prefix, over limit they are dropped
+class ClientRateLimiter():
+
+    def __init__(self, rate, burst=None):
+        self.buckets = TokenBuckets(rate, burst)
+
+    def allow(self, ip):
+        return not self.buckets.limited(client_prefix(ip))
+
+
+# response rate limiting (like BIND RRL): identical responses (name, type,
+# rcode) to one client prefix over rate per second are dropped, every
+# slip-th of them is sent truncated instead, so real clients retry over tcp
+# and victims of spoofed queries get nothing bigger than the query
+class ResponseRateLimiter():
+
+    def __init__(self, rate, slip=RRL_SLIP):
+        self.buckets = TokenBuckets(rate)
+        self.slip = slip
+
+    def check(self, ip, name, qtype_code, rcode):
+        limited = self.buckets.limited((client_prefix(ip), name, qtype_code, rcode))
+        if not limited:
+            return SEND
+        if self.slip and limited % self.slip == 0:
+            return SLIP
+        return DROP
@@ -0,0 +1,76 @@
+import asyncio
+from struct import pack, unpack_from
+from constants import TCP_IDLE_TIMEOUT, TCP_MSG_MAX_SIZE
+
+
+# receives client datagrams on the event loop and hands them to server
+class DNSDatagramProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        self.server._handle_datagram(self.transport, address, data)
+
+    def error_received(self, exc):
+        # icmp errors from clients (e.g. port unreachable) are not fatal
+        pass
+
+
+# dns over tcp client connection (RFC 7766): several length prefixed queries
+# on one connection, each is answered as soon as it is ready, in any order
+class DNSStreamProtocol(asyncio.Protocol):
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.address = None
+        self.buffer = bytearray()
+        self.pending = 0
+        self.idle_handle = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.address = transport.get_extra_info('peername')
+        self._reset_idle()
+
+    def data_received(self, data):
+        self.buffer += data
+        while len(self.buffer) >= 2:
+            length = unpack_from('!H', self.buffer)[0]
+            if len(self.buffer) < 2 + length:
+                break
+            message = bytes(self.buffer[2:2 + length])
+            del self.buffer[:2 + length]
+            self.pending += 1
+            if not self.server._handle_query(message, self._reply, TCP_MSG_MAX_SIZE,
+                                             self.address):
+                self.transport.close()
+                return
+        self._reset_idle()
+
+    def _reply(self, response):
+        self.pending -= 1
+        if not self.transport.is_closing():
+            self.transport.write(pack('!H', len(response)) + response)
+        self._reset_idle()
+
+    def _reset_idle(self):
+        if self.idle_handle is not None:
+            self.idle_handle.cancel()
+        self.idle_handle = asyncio.get_event_loop().call_later(
+            TCP_IDLE_TIMEOUT, self._close_idle)
+
+    def _close_idle(self):
+        if self.pending:
+            self._reset_idle()
+        else:
+            self.transport.close()
+
+    def connection_lost(self, exc):
+        if self.idle_handle is not None:
+            self.idle_handle.cancel()
@@ -0,0 +1,186 @@
+import argparse
+import asyncio
+import json
+import sys
+import traceback
+from parser import DNSMessageParser
+from cache import ResolverCache
+from cache_store import dump_cache, load_cache_snapshot, write_cache_snapshot
+from resolver import Resolver
+from constants import (BATCH_CONCURRENCY, ROOT_SERVER_IPS, UPSTREAM_PORT, Types,
+                       random_id)
+
+QUERY_TYPES = {name: code for code, name in Types.reversed_types.items()}
+
+
+# query type given as code or name ('A', 'mx')
+def query_type(qtype):
+    if isinstance(qtype, int):
+        return qtype
+    qtype = qtype.upper()
+    if qtype in QUERY_TYPES:
+        return QUERY_TYPES[qtype]
+    if not qtype.isdigit():
+        raise ValueError('unknown query type %s' % qtype)
+    return int(qtype)
+
+
+# result of one lookup: raw response (None if resolution failed)
+# and its parsed form
+class BatchResult():
+
+    def __init__(self, name, qtype_code, response, error=None):
+        self.name = name
+        self.qtype = qtype_code
+        self.response = response
+        self.error = error
+        self.parsed = DNSMessageParser(bytes(response)) if response else None
+
+    @property
+    def rcode(self):
+        return self.parsed.rcode if self.parsed is not None else None
+
+    @property
+    def answers(self):
+        return self.parsed.answers if self.parsed is not None else []
+
+    def as_dict(self):
+        result = {
+            'name': self.name,
+            'type': Types.reversed_types.get(self.qtype, self.qtype),
+            'rcode': self.rcode,
+            'answers': [{'name': answer.name,
+                         'type': Types.reversed_types.get(answer.rtype, answer.rtype),
+                         'ttl': answer.time_to_leave,
+                         'data': answer.rdata} for answer in self.answers],
+        }
+        if self.parsed is None:
+            result['error'] = self.error or 'no answer'
+        return result
+
+
+# resolves many (name, query type) questions with same resolver, cache and
+# delegations as server uses, at most concurrency lookups run at once and
+# questions are taken from iterable only when there is room for them
+# results come in completion order, not in order of questions
+# one instance runs on one event loop: use resolve_many (own loop) or
+# resolve_many_async (caller's loop), not both
+class BatchResolver():
+
+    def __init__(self, cache=None, resolver=None, concurrency=BATCH_CONCURRENCY,
+                 root_servers=ROOT_SERVER_IPS, upstream_port=UPSTREAM_PORT):
+        self.cache = cache if cache is not None else ResolverCache()
+        self.resolver = resolver if resolver is not None else Resolver(
+            self.cache, root_servers=root_servers, upstream_port=upstream_port)
+        self.concurrency = max(1, concurrency)
+        self.loop = None
+
+    async def resolve(self, name, qtype):
+        name = name if name.endswith('.') else name + '.'
+        # unknown type fails only its own question, not whole batch
+        qtype_code = qtype
+        try:
+            qtype_code = query_type(qtype)
+            response = await self.resolver.resolve(name, qtype_code, random_id())
+        except Exception as error:
+            traceback.print_exc()
+            return BatchResult(name, qtype_code, None, str(error))
+        return BatchResult(name, qtype_code, response)
+
+    # async iterator of BatchResult
+    async def resolve_many_async(self, questions):
+        questions = iter(questions)
+        pending = set()
+        try:
+            while True:
+                while len(pending) < self.concurrency:
+                    question = next(questions, None)
+                    if question is None:
+                        break
+                    pending.add(asyncio.ensure_future(self.resolve(*question)))
+                if not pending:
+                    return
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            # consumer stopped early
+            for task in pending:
+                task.cancel()
+
+    # generator of BatchResult, lookups run on event loop of this resolver
+    def resolve_many(self, questions):
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+        results = self.resolve_many_async(questions)
+        try:
+            while True:
+                try:
+                    yield self.loop.run_until_complete(results.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            self.loop.run_until_complete(results.aclose())
+
+    def close(self):
+        self.resolver.upstream.close()
+        if self.loop is not None:
+            # transports finish closing on loop
+            self.loop.run_until_complete(asyncio.sleep(0))
+            self.loop.close()
+            self.loop = None
+
+
+# 'name' or 'name TYPE' per line, empty lines and '#' comments skipped
+def read_questions(lines, default_qtype='A'):
+    for line in lines:
+        fields = line.split('#', 1)[0].split()
+        if not fields:
+            continue
+        yield fields[0], fields[1] if len(fields) > 1 else default_qtype
+
+
+def parse_options(args):
+    arg_parser = argparse.ArgumentParser(prog='python3 batch.py')
+    arg_parser.add_argument('--input', default=None,
+                            help='file with name [TYPE] per line (default stdin)')
+    arg_parser.add_argument('--output', default=None,
+                            help='json lines results file (default stdout)')
+    arg_parser.add_argument('--qtype', default='A',
+                            help='query type of lines without one')
+    arg_parser.add_argument('--concurrency', type=int, default=BATCH_CONCURRENCY)
+    arg_parser.add_argument('--root-servers', type=lambda ips: ips.split(','),
+                            default=ROOT_SERVER_IPS)
+    arg_parser.add_argument('--upstream-port', type=int, default=UPSTREAM_PORT)
+    arg_parser.add_argument('--cache-snapshot', default=None,
+                            help='load cache from file before and save it after batch')
+    return arg_parser.parse_args(args)
+
+
+# python3 batch.py --input names.txt --output results.jsonl
+def main(args):
+    options = parse_options(args)
+    batch = BatchResolver(concurrency=options.concurrency,
+                          root_servers=options.root_servers,
+                          upstream_port=options.upstream_port)
+    if options.cache_snapshot:
+        load_cache_snapshot(options.cache_snapshot, batch.cache, batch.resolver.delegations)
+    input_file = open(options.input) if options.input else sys.stdin
+    output_file = open(options.output, 'w') if options.output else sys.stdout
+    try:
+        for result in batch.resolve_many(read_questions(input_file, options.qtype)):
+            print(json.dumps(result.as_dict()), file=output_file)
+    finally:
+        if options.input:
+            input_file.close()
+        if options.output:
+            output_file.close()
+        if options.cache_snapshot:
+            write_cache_snapshot(options.cache_snapshot,
+                                 dump_cache(batch.cache, batch.resolver.delegations))
+        batch.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,150 @@
+import argparse
+import json
+import os
+import platform
+import shlex
+import socket
+import subprocess
+import sys
+import time
+from benchmark.fake_hierarchy import FakeHierarchy, HIERARCHY_PORT
+from benchmark.load_generator import LoadGenerator, build_query
+from benchmark.scenarios import SCENARIOS
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_IP = '127.0.0.1'
+SERVER_START_TIMEOUT = 10
+
+
+def parse_options(args):
+    arg_parser = argparse.ArgumentParser(prog='python -m benchmark')
+    arg_parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                            help='scenario to run, can be repeated (default: all)')
+    arg_parser.add_argument('--queries', type=int, default=10000,
+                            help='measured queries per scenario')
+    arg_parser.add_argument('--duration', type=float, default=None,
+                            help='stop scenario after this many seconds')
+    arg_parser.add_argument('--concurrency', type=int, default=50,
+                            help='queries kept outstanding by load generator')
+    arg_parser.add_argument('--timeout', type=float, default=2,
+                            help='seconds query waits for reply before counted lost')
+    arg_parser.add_argument('--latency', type=float, default=1,
+                            help='milliseconds fake name servers wait before reply')
+    arg_parser.add_argument('--loss', type=float, default=0,
+                            help='fraction of upstream queries fake servers drop (0..1)')
+    arg_parser.add_argument('--hot-names', type=int, default=100,
+                            help='names warmed into cache for cache and mixed scenarios')
+    arg_parser.add_argument('--zone', default='example.com.',
+                            help='zone file name asked in zone scenario')
+    arg_parser.add_argument('--seed', type=int, default=1)
+    arg_parser.add_argument('--config', default=os.path.join(REPO_DIR, 'config'),
+                            help='zone files directory of server')
+    arg_parser.add_argument('--port', type=int, default=5380,
+                            help='port benchmarked server listens on')
+    arg_parser.add_argument('--hierarchy-port', type=int, default=HIERARCHY_PORT)
+    arg_parser.add_argument('--server-args', default='--mode async',
+                            help='extra main.py options, e.g. "--mode async --workers 2"')
+    arg_parser.add_argument('--output', default=None,
+                            help='write json results to file instead of stdout')
+    return arg_parser.parse_args(args)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _wait_for_server(options, process):
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    probe.settimeout(0.2)
+    message = build_query(options.zone, 1)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    try:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                break
+            probe.sendto(message, (SERVER_IP, options.port))
+            try:
+                probe.recv(4096)
+                return
+            except OSError:
+                continue
+    finally:
+        probe.close()
+    process.kill()
+    raise RuntimeError('benchmarked server did not start')
+
+
+# fresh main.py process per scenario, recursion goes to fake hierarchy
+def start_server(options, hierarchy):
+    command = [sys.executable, os.path.join(REPO_DIR, 'main.py'), options.config,
+               SERVER_IP, str(options.port),
+               '--root-servers', hierarchy.root_ip,
+               '--upstream-port', str(hierarchy.port)] + shlex.split(options.server_args)
+    process = subprocess.Popen(command, cwd=REPO_DIR, stdout=subprocess.DEVNULL)
+    _wait_for_server(options, process)
+    return process
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def _upstream_delta(before, after):
+    return {role: {key: after[role][key] - before[role][key] for key in after[role]}
+            for role in after}
+
+
+def run_scenario(name, options, hierarchy):
+    warm_up, questions = SCENARIOS[name](options)
+    process = start_server(options, hierarchy)
+    try:
+        generator = LoadGenerator(SERVER_IP, options.port, options.concurrency,
+                                  options.timeout)
+        if warm_up:
+            generator.run(warm_up)
+        upstream_before = hierarchy.stats()
+        result = generator.run(questions, options.queries, options.duration)
+        result['upstream'] = _upstream_delta(upstream_before, hierarchy.stats())
+    finally:
+        stop_server(process)
+    return result
+
+
+def main(args):
+    options = parse_options(args)
+    hierarchy = FakeHierarchy(options.latency / 1000, options.loss, options.hierarchy_port)
+    hierarchy.start()
+    results = {}
+    try:
+        for name in options.scenario or list(SCENARIOS):
+            print(f'running {name}', file=sys.stderr)
+            results[name] = run_scenario(name, options, hierarchy)
+    finally:
+        hierarchy.stop()
+    report = {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'settings': {key: value for key, value in vars(options).items()
+                     if key not in ('output', 'scenario')},
+        'scenarios': results,
+    }
+    text = json.dumps(report, indent=2)
+    if options.output:
+        with open(options.output, 'w') as f:
+            print(text, file=f)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
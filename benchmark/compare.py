@@ -0,0 +1,33 @@
+import json
+import sys
+
+# lower is better for latencies, higher for qps
+METRICS = (('qps', lambda result: result['qps']),
+           ('p50', lambda result: result['latency_ms']['p50']),
+           ('p99', lambda result: result['latency_ms']['p99']),
+           ('p999', lambda result: result['latency_ms']['p999']))
+
+
+def _change(old, new):
+    if not old or new is None:
+        return '    n/a'
+    return f'{(new - old) / old * 100:+6.1f}%'
+
+
+# print metrics of two benchmark json reports side by side
+def compare(old_report, new_report):
+    print(f'old {old_report.get("commit")}  new {new_report.get("commit")}')
+    for name, new in new_report['scenarios'].items():
+        old = old_report['scenarios'].get(name)
+        if old is None:
+            continue
+        print(name)
+        for metric, value in METRICS:
+            print(f'  {metric:5} {value(old)!s:>12} {value(new)!s:>12} '
+                  f'{_change(value(old), value(new))}')
+
+
+# python -m benchmark.compare old.json new.json
+if __name__ == '__main__':
+    with open(sys.argv[1]) as old_file, open(sys.argv[2]) as new_file:
+        compare(json.load(old_file), json.load(new_file))
@@ -0,0 +1,194 @@
+import argparse
+import asyncio
+import random
+import threading
+import time
+import zlib
+from parser import DNSMessageParser
+from builder import DNSMessageBuilder
+from constants import ResponseCode, Types
+
+# loopback addresses of fake servers (linux routes whole 127.0.0.0/8 to lo)
+ROOT_IP = '127.0.0.2'
+TLD_IP = '127.0.0.3'
+AUTH_IP = '127.0.0.4'
+HIERARCHY_PORT = 5399
+# every benchmark name lives under this tld, each second level name
+# is its own zone served by authoritative server
+TLD = 'test.'
+ANSWER_TTL = 3600
+REFERRAL_TTL = 86400
+NEGATIVE_TTL = 60
+
+
+def _soa(zone):
+    return f'ns.{zone} hostmaster.{zone} 1 3600 600 86400 {NEGATIVE_TTL}'
+
+
+# address every name answers with, stable between runs
+def name_address(name):
+    checksum = zlib.crc32(name.lower().encode('utf-8'))
+    return f'10.{checksum >> 16 & 0xFF}.{checksum >> 8 & 0xFF}.{checksum & 0xFF}'
+
+
+def _start_response(builder, question, aa, counts, rcode=ResponseCode.NO_ERROR):
+    builder.build_flags(qr=1, aa=aa, rd=0, ra=0, rcode=rcode)
+    builder.build_head(1, *counts)
+    builder.build_query(question.name, question.qtype, question.qclass)
+
+
+def _referral(builder, question, zone, ns_ip):
+    ns_name = 'ns.' + zone
+    _start_response(builder, question, 0, (0, 1, 1))
+    builder.build_authority(zone, Types.NS, 1, REFERRAL_TTL, ns_name)
+    builder.build_additional(ns_name, Types.A, 1, REFERRAL_TTL, ns_ip)
+
+
+# NXDOMAIN or NODATA with zone SOA
+def _negative(builder, question, zone, rcode):
+    _start_response(builder, question, 1, (0, 1, 0), rcode)
+    builder.build_authority(zone, Types.SOA, 1, NEGATIVE_TTL, _soa(zone))
+
+
+# one fake name server, answers after latency seconds and
+# drops loss fraction (0..1) of queries without reply
+class FakeServerProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, handler, latency=0, loss=0):
+        self.handler = handler
+        self.latency = latency
+        self.loss = loss
+        self.transport = None
+        self.queries = 0
+        self.dropped = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        self.queries += 1
+        if self.loss and random.random() < self.loss:
+            self.dropped += 1
+            return
+        try:
+            parsed_message = DNSMessageParser(data, lazy=True)
+            question = parsed_message.questions[0]
+        except Exception:
+            return
+        builder = DNSMessageBuilder(parsed_message.request_id)
+        self.handler(builder, question)
+        if self.latency:
+            asyncio.get_event_loop().call_later(
+                self.latency, self.transport.sendto, builder.message, address)
+        else:
+            self.transport.sendto(builder.message, address)
+
+    def error_received(self, exc):
+        pass
+
+
+# root, tld and authoritative servers of TLD on loopback,
+# served from own thread and event loop
+class FakeHierarchy():
+
+    def __init__(self, latency=0, loss=0, port=HIERARCHY_PORT, root_ip=ROOT_IP,
+                 tld_ip=TLD_IP, auth_ip=AUTH_IP, answer_ttl=ANSWER_TTL):
+        self.latency = latency
+        self.loss = loss
+        self.port = port
+        self.root_ip = root_ip
+        self.tld_ip = tld_ip
+        self.auth_ip = auth_ip
+        self.answer_ttl = answer_ttl
+        self.servers = {}  # role: FakeServerProtocol
+        self.transports = []
+        self.loop = None
+        self.thread = None
+
+    def _root(self, builder, question):
+        name = question.name.lower()
+        if name == TLD or name.endswith('.' + TLD):
+            _referral(builder, question, TLD, self.tld_ip)
+        else:
+            _negative(builder, question, '', ResponseCode.NAME_ERROR)
+
+    def _tld(self, builder, question):
+        labels = question.name.lower().split('.')
+        if len(labels) < 3:
+            _negative(builder, question, TLD, ResponseCode.NO_ERROR)
+        else:
+            _referral(builder, question, labels[-3] + '.' + TLD, self.auth_ip)
+
+    def _auth(self, builder, question):
+        name = question.name.lower()
+        zone = '.'.join(name.split('.')[-3:])
+        if question.qtype != Types.A:
+            _negative(builder, question, zone, ResponseCode.NO_ERROR)
+            return
+        _start_response(builder, question, 1, (1, 0, 0))
+        address = self.auth_ip if name == 'ns.' + zone else name_address(name)
+        builder.build_answer(question.name, Types.A, 1, self.answer_ttl, address)
+
+    async def _start_servers(self):
+        loop = asyncio.get_event_loop()
+        for role, ip, handler in (('root', self.root_ip, self._root),
+                                  ('tld', self.tld_ip, self._tld),
+                                  ('auth', self.auth_ip, self._auth)):
+            protocol = FakeServerProtocol(handler, self.latency, self.loss)
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: protocol, local_addr=(ip, self.port))
+            self.servers[role] = protocol
+            self.transports.append(transport)
+
+    def _run(self, started):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._start_servers())
+        except Exception as error:
+            started.append(error)
+            return
+        started.append(None)
+        self.loop.run_forever()
+        for transport in self.transports:
+            transport.close()
+        self.loop.close()
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        started = []
+        self.thread = threading.Thread(target=self._run, args=(started,), daemon=True)
+        self.thread.start()
+        while not started:
+            time.sleep(0.01)
+        if started[0] is not None:
+            raise started[0]
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    # queries received and dropped by every server
+    def stats(self):
+        return {role: {'queries': server.queries, 'dropped': server.dropped}
+                for role, server in self.servers.items()}
+
+
+# run hierarchy alone, e.g. for server started by hand with
+# --root-servers 127.0.0.2 --upstream-port 5399
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(prog='python -m benchmark.fake_hierarchy')
+    arg_parser.add_argument('--latency', type=float, default=0,
+                            help='milliseconds every server waits before reply')
+    arg_parser.add_argument('--loss', type=float, default=0,
+                            help='fraction of queries dropped (0..1)')
+    arg_parser.add_argument('--port', type=int, default=HIERARCHY_PORT)
+    options = arg_parser.parse_args()
+    hierarchy = FakeHierarchy(options.latency / 1000, options.loss, options.port)
+    hierarchy.start()
+    print(f'root {hierarchy.root_ip}, tld {TLD} {hierarchy.tld_ip}, '
+          f'zones *.{TLD} {hierarchy.auth_ip}, port {hierarchy.port}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        hierarchy.stop()
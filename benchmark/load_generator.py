@@ -0,0 +1,143 @@
+import asyncio
+import math
+import random
+from collections import deque
+from struct import unpack_from
+from time import monotonic, perf_counter
+from builder import DNSMessageBuilder, set_request_id
+
+
+# client side of load generator, replies are matched to queries by id
+class LoadClientProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self):
+        self.transport = None
+        self.pending = {}  # message id: future
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        if len(data) < 12:
+            return
+        future = self.pending.pop(unpack_from('!H', data)[0], None)
+        if future is not None and not future.done():
+            future.set_result(data)
+
+    def error_received(self, exc):
+        pass
+
+
+def build_query(name, qtype_code):
+    builder = DNSMessageBuilder(0)
+    builder.build_flags(rd=1, ra=0)
+    builder.build_head(1, 0, 0, 0)
+    builder.build_query(name, qtype_code, 1)
+    return builder.message
+
+
+# value below which fraction of sorted values lie
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+# sends (name, qtype) questions to server over udp keeping concurrency
+# queries outstanding, until questions run out, count queries are sent
+# or duration seconds pass
+class LoadGenerator():
+
+    def __init__(self, server_ip, server_port, concurrency=50, timeout=2):
+        self.server = (server_ip, server_port)
+        self.concurrency = concurrency
+        self.timeout = timeout
+        # query messages with id 0 by question, id is patched per query
+        self.templates = {}
+        # ids not used by outstanding queries, ids of timed out queries
+        # go to the end so late replies do not match new queries
+        self.free_ids = deque(random.sample(range(1 << 16), 1 << 16))
+
+    def _message(self, name, qtype_code, message_id):
+        template = self.templates.get((name, qtype_code))
+        if template is None:
+            template = self.templates[(name, qtype_code)] = build_query(name, qtype_code)
+        return set_request_id(template, message_id)
+
+    async def _worker(self, protocol, questions, deadline, result):
+        loop = asyncio.get_event_loop()
+        for name, qtype_code in questions:
+            if deadline is not None and monotonic() >= deadline:
+                return
+            message_id = self.free_ids.popleft()
+            future = protocol.pending[message_id] = loop.create_future()
+            result['sent'] += 1
+            started = perf_counter()
+            protocol.transport.sendto(self._message(name, qtype_code, message_id))
+            try:
+                response = await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                protocol.pending.pop(message_id, None)
+                result['timeouts'] += 1
+                self.free_ids.append(message_id)
+                continue
+            result['latencies'].append(perf_counter() - started)
+            self.free_ids.appendleft(message_id)
+            rcode = response[3] & 0xF
+            result['rcodes'][rcode] = result['rcodes'].get(rcode, 0) + 1
+            if response[2] & 0x2:
+                result['truncated'] += 1
+
+    async def _run(self, questions, duration):
+        loop = asyncio.get_event_loop()
+        transport, protocol = await loop.create_datagram_endpoint(
+            LoadClientProtocol, remote_addr=self.server)
+        result = {'sent': 0, 'timeouts': 0, 'truncated': 0, 'rcodes': {}, 'latencies': []}
+        deadline = monotonic() + duration if duration else None
+        # workers share one iterator, each takes next question when free
+        questions = iter(questions)
+        started = perf_counter()
+        try:
+            await asyncio.gather(*[self._worker(protocol, questions, deadline, result)
+                                   for _ in range(self.concurrency)])
+        finally:
+            transport.close()
+        result['seconds'] = perf_counter() - started
+        return result
+
+    # returns summary dict: counts, qps and latency percentiles in milliseconds
+    def run(self, questions, count=None, duration=None):
+        if count is not None:
+            questions = (question for _, question in zip(range(count), questions))
+        loop = asyncio.new_event_loop()
+        try:
+            result = loop.run_until_complete(self._run(questions, duration))
+        finally:
+            loop.close()
+        return summarize(result)
+
+
+def summarize(result):
+    latencies = sorted(result['latencies'])
+    seconds = result['seconds']
+
+    def milliseconds(value):
+        return round(value * 1000, 3) if value is not None else None
+
+    return {
+        'queries': result['sent'],
+        'answered': len(latencies),
+        'timeouts': result['timeouts'],
+        'truncated': result['truncated'],
+        'rcodes': {str(rcode): count for rcode, count in sorted(result['rcodes'].items())},
+        'seconds': round(seconds, 3),
+        'qps': round(len(latencies) / seconds, 1) if seconds else 0,
+        'latency_ms': {
+            'mean': milliseconds(sum(latencies) / len(latencies) if latencies else None),
+            'p50': milliseconds(percentile(latencies, 0.5)),
+            'p99': milliseconds(percentile(latencies, 0.99)),
+            'p999': milliseconds(percentile(latencies, 0.999)),
+            'max': milliseconds(latencies[-1] if latencies else None),
+        },
+    }
@@ -0,0 +1,57 @@
+import itertools
+import random
+from benchmark.fake_hierarchy import TLD
+from constants import Types
+
+ZONE_QTYPES = (Types.A, Types.MX, Types.NS, Types.TXT, Types.SOA, Types.AAAA)
+# share of zone, cache and cold questions in mixed traffic
+MIXED_WEIGHTS = (0.3, 0.6, 0.1)
+
+
+# every scenario returns (questions asked before measuring,
+# endless iterator of measured (name, qtype) questions)
+
+# names from local zone files, answered from zone index
+def zone_hits(options):
+    return [], itertools.cycle([(options.zone, qtype) for qtype in ZONE_QTYPES])
+
+
+def _hot_names(options):
+    return [(f'www.h{index}.{TLD}', Types.A) for index in range(options.hot_names)]
+
+
+# fixed set of names resolved once during warm up, then served from cache
+def cache_hits(options):
+    hot_names = _hot_names(options)
+    return hot_names, itertools.cycle(hot_names)
+
+
+# every question is new name in new zone: tld referral and
+# authoritative answer come from fake hierarchy each time
+def _cold_names(run_id):
+    return ((f'www.c{run_id}x{index}.{TLD}', Types.A) for index in itertools.count())
+
+
+def cold_misses(options):
+    return [], _cold_names(random.getrandbits(32))
+
+
+def mixed(options):
+    hot_names = _hot_names(options)
+    sources = (zone_hits(options)[1], itertools.cycle(hot_names),
+               _cold_names(random.getrandbits(32)))
+    choices = random.Random(options.seed)
+
+    def questions():
+        while True:
+            yield next(choices.choices(sources, MIXED_WEIGHTS)[0])
+
+    return hot_names, questions()
+
+
+SCENARIOS = {
+    'zone': zone_hits,
+    'cache': cache_hits,
+    'cold': cold_misses,
+    'mixed': mixed,
+}
@@ -1,99 +1,235 @@
-from struct import pack
-from constants import Types, write_in_file
+import socket
+from parser import DNSMessageParser
+from struct import pack, pack_into, unpack_from
+from constants import EDNS_UDP_SIZE, MSG_MAX_SIZE, Types, write_in_file
 from ipaddress import IPv6Address
 
+# compression pointers can address only first 16K of message
+MAX_POINTER_OFFSET = 0x3FFF
+# name of first question always starts right after header
+QUESTION_NAME_POINTER = 0xC000 | 12
+# root name, type, payload size, flags, no options
+OPT_RECORD_SIZE = 11
 
+
+# writes dns message into preallocated bytearray, grown when full
+# domain names are compressed (RFC 1035 4.1.4) against names already written,
+# responses are fitted to client size limit when sent (fit_response)
+# compress=False writes every name in full, so written records can be
+# copied into other messages
 class DNSMessageBuilder():
 
-    def __init__(self, request_id):
+    def __init__(self, request_id, compress=True):
         self.request_id = request_id
-        self.message = b''
+        self.compress = compress
+        self.buffer = bytearray(MSG_MAX_SIZE)
+        self.offset = 0
+        self.flags = 0
+        # lower cased name suffix: offset where it was written
+        self.names = {}
+
+    @property
+    def message(self):
+        return bytes(self.buffer[:self.offset])
+
+    def _reserve(self, length):
+        end = self.offset + length
+        if end > len(self.buffer):
+            self.buffer.extend(bytes(max(end, 2 * len(self.buffer)) - len(self.buffer)))
+        return self.offset
+
+    def _write(self, data):
+        offset = self._reserve(len(data))
+        self.buffer[offset:offset + len(data)] = data
+        self.offset += len(data)
+
+    def _pack(self, fmt, length, *values):
+        pack_into(fmt, self.buffer, self._reserve(length), *values)
+        self.offset += length
 
     def build_flags(self, qr=0, opcode=0, aa=0, tc=0, rd=1, ra=1, z=0, rcode=0):
         # self.flags
         flags = 0
         flags |= qr << 15
-        flags |= opcode  # opcode
+        flags |= opcode << 11  # opcode
         flags |= aa << 10
         flags |= tc << 9
         flags |= rd << 8
         flags |= ra << 7
-        flags |= z  # Z
+        flags |= z << 4  # Z
         flags |= rcode
         self.flags = flags
 
     def build_head(self, count_questions, count_answers, count_authorities, count_additional):
-        self.message += pack('!HHHHHH', self.request_id, self.flags, count_questions,
-                             count_answers, count_authorities, count_additional)
-
-    @staticmethod
-    def _build_name(domain_name):
-        query_list = []
-        parts = domain_name.split('.')
-        overall_length = len(parts)
-        for part in parts:
-            part_length = len(part)
-            overall_length += part_length
-            if part_length > 63 or overall_length > 255:
-                # error
-                pass
-            query_list.append(pack("!B", part_length))
-            query_list.append(part.encode('utf-8'))
-        query_list.append(bytes(0))
-        return b"".join(query_list)
+        self._pack('!HHHHHH', 12, self.request_id, self.flags, count_questions,
+                   count_answers, count_authorities, count_additional)
+
+    def _write_name(self, domain_name):
+        labels = [label for label in domain_name.split('.') if label]
+        for index in range(len(labels)):
+            if not self.compress:
+                self._write_label(labels[index], domain_name)
+                continue
+            suffix = '.'.join(labels[index:]).lower()
+            pointer = self.names.get(suffix)
+            if pointer is not None:
+                self._pack('!H', 2, 0xC000 | pointer)
+                return
+            if self.offset <= MAX_POINTER_OFFSET:
+                self.names[suffix] = self.offset
+            self._write_label(labels[index], domain_name)
+        self._pack('!B', 1, 0)
+
+    def _write_label(self, label, domain_name):
+        label = label.encode('utf-8')
+        if len(label) > 63:
+            raise ValueError(f'label longer than 63 bytes in {domain_name}')
+        self._pack('!B', 1, len(label))
+        self._write(label)
 
     def build_query(self, domain_name, qtype, qclass):
-        self.message += self._build_name(domain_name) + \
-            pack('!H', qtype) + pack('!H', qclass)
+        self._write_name(domain_name)
+        self._pack('!HH', 4, qtype, qclass)
 
     def _build_response_data(self, answer_type, data):
         if answer_type == Types.A:
-            ip_bytes = data.split('.')
-            return pack('!BBBB', *map(int, ip_bytes))
-        if answer_type == Types.CNAME or answer_type == Types.NS:
-            return self._build_name(data)
-        if answer_type == Types.MX:
-            pref = pack('!H', data[0])
-            mail = self._build_name(data[1])
-            return pref + mail
-        if answer_type == Types.SOA:
-            soa = data.split()
-            name_server = self._build_name(soa[0])
-            host = self._build_name(soa[1])
-            rest_info = pack(
-                '!IIIII', int(soa[2]), int(soa[3]), int(soa[4]), int(soa[5]), int(soa[6]))
-            return name_server + host + rest_info
-        if answer_type == Types.TXT:
+            self._write(socket.inet_aton(data))
+        elif answer_type == Types.CNAME or answer_type == Types.NS:
+            self._write_name(data)
+        elif answer_type == Types.MX:
+            self._pack('!H', 2, int(data[0]))
+            self._write_name(data[1])
+        elif answer_type == Types.SOA:
+            soa = data.split() if isinstance(data, str) else data
+            self._write_name(soa[0])
+            self._write_name(soa[1])
+            self._pack('!IIIII', 20, int(soa[2]), int(soa[3]), int(soa[4]),
+                       int(soa[5]), int(soa[6]))
+        elif answer_type == Types.TXT:
+            # character strings are at most 255 bytes long
             text = data.encode('utf-8')
-            text_len = pack('!B', len(text))
-            return text_len + text
-        if answer_type == Types.AAAA:
-            return IPv6Address(data)._ip.to_bytes(16, 'big')
-        # unsupported
-        return b""
+            for index in range(0, max(len(text), 1), 255):
+                chunk = text[index:index + 255]
+                self._pack('!B', 1, len(chunk))
+                self._write(chunk)
+        elif answer_type == Types.AAAA:
+            self._write(IPv6Address(data).packed)
+        # unsupported types get empty data
 
     def _build_result_set(self, domain_name, answer_type, answer_class,
                           ttl, data):
-        name = self._build_name(domain_name)
-        atype = pack('!H', answer_type)
-        aclass = pack('!H', answer_class)
-        time_to_leave = pack('!I', ttl)
-        response_data = self._build_response_data(answer_type, data)
-        response_data_length = pack('!H', len(response_data))
-        self.message += name + atype + aclass + \
-            time_to_leave+response_data_length+response_data
+        # None: owner is name of question
+        if domain_name is None:
+            self._pack('!H', 2, QUESTION_NAME_POINTER)
+        else:
+            self._write_name(domain_name)
+        self._pack('!HHI', 8, answer_type, answer_class, ttl)
+        length_index = self._reserve(2)
+        self.offset += 2
+        self._build_response_data(answer_type, data)
+        pack_into('!H', self.buffer, length_index, self.offset - length_index - 2)
+
+    def build_opt(self, udp_payload_size=EDNS_UDP_SIZE, extended_rcode=0, version=0,
+                  dnssec_ok=0):
+        flags = extended_rcode << 24 | version << 16 | dnssec_ok << 15
+        self._build_result_set('', Types.OPT, udp_payload_size, flags, None)
 
     def build_answer(self, domain_name, answer_type, answer_class,
                      ttl, data):
-        self._build_result_set(domain_name, answer_type, answer_class,
-                               ttl, data)
+        self._build_result_set(domain_name, answer_type, answer_class, ttl, data)
 
     def build_authority(self, domain_name, answer_type, answer_class,
                         ttl, data):
-        self._build_result_set(domain_name, answer_type, answer_class,
-                               ttl, data)
+        self._build_result_set(domain_name, answer_type, answer_class, ttl, data)
 
     def build_additional(self, domain_name, answer_type, answer_class,
                          ttl, data):
-        self._build_result_set(domain_name, answer_type, answer_class,
-                               ttl, data)
+        self._build_result_set(domain_name, answer_type, answer_class, ttl, data)
+
+
+# copy of response with other request id
+def set_request_id(response, request_id):
+    response = bytearray(response)
+    pack_into('!H', response, 0, request_id)
+    return response
+
+
+# write question name of response (in place) as asker spelled it,
+# responses cached or shared for same name in other case are sent back
+# with the spelling client expects (0x20 case randomization)
+def spell_question(response, name):
+    encoded = bytearray()
+    for label in name.split('.'):
+        if label:
+            label = label.encode('utf-8')
+            encoded += pack('!B', len(label)) + label
+    encoded += b'\x00'
+    end = 12 + len(encoded)
+    # only case may differ, anything else is left as it is
+    if response[12:end].lower() == encoded.lower():
+        response[12:end] = encoded
+    return response
+
+
+def opt_record(udp_payload_size=EDNS_UDP_SIZE, extended_rcode=0):
+    return pack('!BHHIH', 0, Types.OPT, udp_payload_size, extended_rcode << 24, 0)
+
+
+OPT_RECORD = opt_record()
+# extended rcode 16 (BADVERS) = 1 << 4 | 0
+BADVERS_OPT_RECORD = opt_record(extended_rcode=1)
+
+
+# header and question of response with TC flag, tells client to retry over tcp
+def truncate_response(response):
+    question_end = DNSMessageParser(response, lazy=True).question_section_end()
+    truncated = bytearray(response[:question_end])
+    flags = unpack_from('!H', truncated, 2)[0] | 1 << 9
+    pack_into('!HHHHH', truncated, 2, flags, 1, 0, 0, 0)
+    return truncated
+
+
+# response without EDNS0 OPT record of whoever built it (upstream server)
+def strip_opt(response, parsed_response):
+    span = parsed_response.opt_span()
+    if span is None:
+        return response
+    stripped = bytearray(response[:span[0]])
+    stripped += response[span[1]:]
+    pack_into('!H', stripped, 10, parsed_response.count_additional - 1)
+    return stripped
+
+
+# longest part of response that fits max_size: whole records are kept while
+# they fit (compression pointers point only back, so they stay valid),
+# TC is set when answer or authority records are dropped, dropped additional
+# records are optional data (RFC 2181 9)
+def _cut_response(response, max_size):
+    parsed_response = DNSMessageParser(response, lazy=True)
+    end = parsed_response.question_section_end()
+    counts = [0, 0, 0, 0]
+    for section, record_end in parsed_response.record_ends():
+        if record_end > max_size:
+            break
+        end = record_end
+        counts[section] += 1
+    cut = bytearray(response[:end])
+    flags = parsed_response.flags
+    if counts[1] < parsed_response.count_answers or \
+            counts[2] < parsed_response.count_authorities:
+        flags |= 1 << 9
+    pack_into('!HHHHH', cut, 2, flags, parsed_response.count_questions, *counts[1:])
+    return cut
+
+
+# make response fit max size client accepts and add opt record
+# (for clients that sent one)
+def fit_response(response, max_size, opt=None):
+    extra = len(opt) if opt else 0
+    if len(response) + extra > max_size:
+        response = _cut_response(response, max_size - extra)
+    if opt:
+        response = bytearray(response)
+        pack_into('!H', response, 10, unpack_from('!H', response, 10)[0] + 1)
+        response += opt
+    return response
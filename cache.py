@@ -0,0 +1,184 @@
+import threading
+from collections import OrderedDict
+from struct import pack_into
+from time import monotonic
+from builder import spell_question
+from constants import (CACHE_MAX_BYTES, CACHE_MAX_ENTRIES, CACHE_PREFETCH_HITS,
+                       CACHE_PREFETCH_WINDOW, CACHE_SHARDS, CACHE_STALE_TTL,
+                       STALE_ANSWER_TTL, ResponseCode, Types)
+
+# approximate memory used by entry besides response bytes
+ENTRY_OVERHEAD = 200
+
+
+class CacheEntry():
+    __slots__ = ('response', 'ttls', 'stored_at', 'expires_at', 'size', 'hits',
+                 'prefetching')
+
+    def __init__(self, response, ttls, time_to_leave, now):
+        self.response = response
+        # (ttl field index, original ttl) of every result set
+        self.ttls = ttls
+        self.stored_at = now
+        self.expires_at = now + time_to_leave
+        self.size = len(response) + ENTRY_OVERHEAD
+        # times entry was answered, hot entries are prefetched before expiry
+        self.hits = 0
+        self.prefetching = False
+
+
+# returns how long response may be cached:
+# minimum ttl of all result sets (record_ttls) for answers,
+# SOA minimum (capped by SOA ttl) for NXDOMAIN/NODATA,
+# None if response should not be cached
+def response_ttl(parsed_response, record_ttls):
+    if parsed_response.rcode == ResponseCode.NO_ERROR and parsed_response.count_answers > 0:
+        return min(time_to_leave for _, time_to_leave, rtype in record_ttls
+                   if rtype != Types.OPT)
+    if parsed_response.rcode in (ResponseCode.NO_ERROR, ResponseCode.NAME_ERROR):
+        for auth in parsed_response.authorities:
+            if auth.rtype == Types.SOA:
+                return min(auth.time_to_leave, auth.rdata[-1])
+    return None
+
+
+# one lock protected part of cache with its own lru order and limits
+class _CacheShard():
+
+    def __init__(self, max_entries, max_bytes, stale_ttl):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stale_ttl = stale_ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, now):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at <= now:
+                # expired entry stays for serve-stale until stale ttl is over too
+                if entry.expires_at + self.stale_ttl <= now:
+                    self._remove(key)
+                return None
+            entry.hits += 1
+            self.entries.move_to_end(key)
+            return entry
+
+    # entry expired less than stale ttl ago (or still fresh)
+    def get_stale(self, key, now):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.expires_at + self.stale_ttl <= now:
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = entry
+            self.size += entry.size
+            # least recently used entries go first
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        self.size -= self.entries.pop(key).size
+
+
+# bounded ttl/lru cache of resolver responses keyed by (lower cased domain name,
+# query type), answers get question spelled as asker wrote it
+# safe to share between threads, each shard has its own lock
+# entry answered prefetch_hits times whose ttl is nearly over is passed to
+# on_prefetch(name, qtype) once, so it can be resolved again before it expires
+# expired entries are kept stale_ttl seconds more for get_stale (RFC 8767)
+class ResolverCache():
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES,
+                 shards=CACHE_SHARDS, prefetch_hits=CACHE_PREFETCH_HITS,
+                 stale_ttl=CACHE_STALE_TTL):
+        self.shards = [_CacheShard(max(1, max_entries // shards), max(1, max_bytes // shards),
+                                   stale_ttl)
+                       for _ in range(shards)]
+        self.prefetch_hits = prefetch_hits
+        self.stale_ttl = stale_ttl
+        self.on_prefetch = None
+
+    def _shard(self, key):
+        return self.shards[hash(key) % len(self.shards)]
+
+    def put(self, name, qtype_code, response, parsed_response):
+        record_ttls = parsed_response.record_ttls()
+        time_to_leave = response_ttl(parsed_response, record_ttls)
+        if not time_to_leave:
+            return False
+        ttls = [(ttl_index, ttl) for ttl_index, ttl, rtype in record_ttls
+                if rtype != Types.OPT]
+        key = (name.lower(), qtype_code)
+        entry = CacheEntry(bytes(response), ttls, time_to_leave, monotonic())
+        self._shard(key).put(key, entry)
+        return True
+
+    # returns cached response with request id of asker and ttls
+    # decremented by time spent in cache, None if missing or expired
+    def get(self, name, qtype_code, request_id):
+        key = (name.lower(), qtype_code)
+        now = monotonic()
+        entry = self._shard(key).get(key, now)
+        if entry is None:
+            return None
+        if self.prefetch_hits and entry.hits >= self.prefetch_hits and \
+                not entry.prefetching and self.on_prefetch is not None and \
+                entry.expires_at - now <= (entry.expires_at - entry.stored_at) * \
+                CACHE_PREFETCH_WINDOW:
+            entry.prefetching = True
+            self.on_prefetch(name, qtype_code)
+        elapsed = int(now - entry.stored_at)
+        response = spell_question(bytearray(entry.response), name)
+        pack_into('!H', response, 0, request_id)
+        if elapsed > 0:
+            for ttl_index, time_to_leave in entry.ttls:
+                pack_into('!I', response, ttl_index, max(0, time_to_leave - elapsed))
+        return response
+
+    # response of expired entry (kept for serve-stale) with ttls set to
+    # STALE_ANSWER_TTL, None if there is none
+    def get_stale(self, name, qtype_code, request_id):
+        if not self.stale_ttl:
+            return None
+        key = (name.lower(), qtype_code)
+        entry = self._shard(key).get_stale(key, monotonic())
+        if entry is None:
+            return None
+        response = spell_question(bytearray(entry.response), name)
+        pack_into('!H', response, 0, request_id)
+        for ttl_index, time_to_leave in entry.ttls:
+            pack_into('!I', response, ttl_index, min(time_to_leave, STALE_ANSWER_TTL))
+        return response
+
+    # entry restored from snapshot
+    def put_entry(self, name, qtype_code, entry):
+        key = (name.lower(), qtype_code)
+        self._shard(key).put(key, entry)
+
+    # ((name, qtype), entry) of every entry, shards are copied one by one
+    # so each lock is held only briefly
+    def items(self):
+        items = []
+        for shard in self.shards:
+            with shard.lock:
+                items.extend(shard.entries.items())
+        return items
+
+    def __len__(self):
+        return sum(len(shard.entries) for shard in self.shards)
+
+    @property
+    def evictions(self):
+        return sum(shard.evictions for shard in self.shards)
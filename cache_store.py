@@ -0,0 +1,118 @@
+import marshal
+import os
+import threading
+import time
+import traceback
+from struct import error as struct_error, pack, unpack_from
+from time import monotonic
+from cache import CacheEntry
+from constants import CACHE_SNAPSHOT_INTERVAL
+
+# snapshot layout: header (magic, wall clock time of dump) and marshalled
+#   (cache entries, zone cuts, name server addresses), times are kept
+#   as seconds left, they are moved by downtime when loaded
+CACHE_SNAPSHOT_MAGIC = b'DNSCACH1'
+CACHE_SNAPSHOT_HEADER = '!8sd'
+CACHE_SNAPSHOT_HEADER_SIZE = 16
+
+
+# copy of cache and delegation state, safe to take while server runs,
+# locks are held only while tables are copied
+def dump_cache(cache, delegations):
+    now = monotonic()
+    entries = [(name, qtype_code, entry.response, entry.ttls,
+                now - entry.stored_at, entry.expires_at - now)
+               for (name, qtype_code), entry in cache.items()
+               if entry.expires_at + cache.stale_ttl > now]
+    zones, addresses = delegations.items() if delegations is not None else ([], [])
+    zones = [(zone, ns_names, expires_at - now)
+             for zone, (ns_names, expires_at) in zones if expires_at > now]
+    addresses = [(ns_name, ips, expires_at - now)
+                 for ns_name, (ips, expires_at) in addresses if expires_at > now]
+    return pack(CACHE_SNAPSHOT_HEADER, CACHE_SNAPSHOT_MAGIC, time.time()) + \
+        marshal.dumps((entries, zones, addresses))
+
+
+# written to temporary file and renamed, readers never see half written snapshot,
+# data is synced before rename so crash can not leave empty file in its place
+def write_cache_snapshot(path, data):
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_path, path)
+
+
+# fill cache and delegations from snapshot, ttls are decreased by time
+# passed since it was written, returns number of cache entries loaded
+# missing or broken snapshot loads nothing
+def load_cache_snapshot(path, cache, delegations):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, written_at = unpack_from(CACHE_SNAPSHOT_HEADER, data, 0)
+        if magic != CACHE_SNAPSHOT_MAGIC:
+            return 0
+        entries, zones, addresses = marshal.loads(data[CACHE_SNAPSHOT_HEADER_SIZE:])
+    except (OSError, ValueError, EOFError, TypeError, struct_error) as error:
+        if not isinstance(error, FileNotFoundError):
+            print(f'cache snapshot {path} not loaded: {error}')
+        return 0
+    downtime = max(0, time.time() - written_at)
+    now = monotonic()
+    loaded = 0
+    for name, qtype_code, response, ttls, age, left in entries:
+        left -= downtime
+        if left + cache.stale_ttl <= 0:
+            continue
+        entry = CacheEntry(response, ttls, 0, now)
+        entry.stored_at = now - age - downtime
+        entry.expires_at = now + left
+        cache.put_entry(name, qtype_code, entry)
+        loaded += 1
+    if delegations is not None:
+        for zone, ns_names, left in zones:
+            delegations.add_delegation(zone, ns_names, left - downtime)
+        for ns_name, ips, left in addresses:
+            delegations.add_addresses(ns_name, ips, left - downtime)
+    return loaded
+
+
+# background thread writing cache snapshot every interval seconds,
+# copying tables is quick, encoding and writing do not hold any lock
+class CacheSnapshotWriter():
+
+    def __init__(self, path, cache, delegations, interval=CACHE_SNAPSHOT_INTERVAL):
+        self.path = path
+        self.cache = cache
+        self.delegations = delegations
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def write(self):
+        write_cache_snapshot(self.path, dump_cache(self.cache, self.delegations))
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self.thread
+
+    # final snapshot on shutdown, written after periodic write in progress ends
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        try:
+            self.write()
+        except Exception:
+            traceback.print_exc()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except Exception:
+                traceback.print_exc()
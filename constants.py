@@ -2,7 +2,83 @@ import sys
 import random
 MSG_SIZE = 512
 MSG_MAX_SIZE = 4096
+# largest message over tcp (2 byte length prefix)
+TCP_MSG_MAX_SIZE = 65535
+# udp payload size advertised in EDNS0 OPT record (DNS flag day 2020)
+EDNS_UDP_SIZE = 1232
+# idle tcp client connections are closed after this many seconds
+TCP_IDLE_TIMEOUT = 10
 ZONE_FILE_EXT = '.conf'
+# compiled zone files, kept in config dir next to them
+ZONE_SNAPSHOT_FILE = '.zones.snapshot'
+# port and timeout (seconds) used for queries sent to name servers
+UPSTREAM_PORT = 53
+UPSTREAM_TIMEOUT = 1
+# timeout of query over tcp, idle upstream tcp connections are closed
+UPSTREAM_TCP_TIMEOUT = 3
+UPSTREAM_TCP_IDLE = 10
+# adaptive timeout never drops below this
+UPSTREAM_MIN_TIMEOUT = 0.2
+# upstream udp sockets kept open, each is replaced after max uses
+# so source ports keep changing
+UPSTREAM_POOL_SIZE = 8
+UPSTREAM_SOCKET_MAX_USES = 1000
+# failing server is skipped for backoff, doubled on every failure in row
+UPSTREAM_BACKOFF = 1
+UPSTREAM_MAX_BACKOFF = 60
+# number of name servers asked at once, first valid reply wins
+UPSTREAM_RACE = 1
+# lookups running at once in batch resolver (batch.py)
+BATCH_CONCURRENCY = 100
+# max number of recursive lookups served concurrently in async mode
+MAX_IN_FLIGHT = 1000
+# recursive lookups waiting for one of in-flight slots, more are shed at once
+# with SERVFAIL (or REFUSED), zone and cache hits never wait
+MAX_QUEUED_RECURSION = 1000
+# clients in same network share query and response rate limits
+CLIENT_PREFIX_V4 = 24
+CLIENT_PREFIX_V6 = 56
+# max clients/responses rate limits are tracked for (least recently seen go)
+RATE_LIMIT_MAX_ENTRIES = 100000
+# every n-th response dropped by response rate limiting is sent truncated
+RRL_SLIP = 2
+# resolver cache limits, split between lock striped shards
+CACHE_MAX_ENTRIES = 100000
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+CACHE_SHARDS = 16
+# cache entry asked this many times is refreshed in background when
+# less than fraction of its ttl is left (0 hits disables prefetch)
+CACHE_PREFETCH_HITS = 3
+CACHE_PREFETCH_WINDOW = 0.1
+# expired entries are kept this many seconds and answered when upstream
+# resolution fails or takes longer than STALE_ANSWER_TIMEOUT (RFC 8767),
+# with ttl STALE_ANSWER_TTL (0 seconds disables serve-stale)
+CACHE_STALE_TTL = 86400
+STALE_ANSWER_TTL = 30
+STALE_ANSWER_TIMEOUT = 1.8
+# seconds between dumps of resolver cache to snapshot file (--cache-snapshot)
+CACHE_SNAPSHOT_INTERVAL = 60
+# max zone cuts and name server addresses kept by delegation cache
+DELEGATION_CACHE_MAX_ENTRIES = 10000
+# max referrals followed by one lookup and max nesting of
+# name server address lookups inside it
+MAX_REFERRALS = 16
+MAX_RESOLUTION_DEPTH = 4
+# max CNAME records followed inside zone for one answer
+MAX_CNAME_CHAIN = 8
+# CHAOS class TXT query answered with server statistics
+STATS_NAME = 'stats.bind.'
+# query log (--query-log): entries waiting for writer thread (more are dropped),
+# seconds between batched writes, file size it is rotated at and files kept
+QUERY_LOG_BUFFER = 65536
+QUERY_LOG_FLUSH_INTERVAL = 1
+QUERY_LOG_MAX_BYTES = 100 * 1024 * 1024
+QUERY_LOG_BACKUPS = 5
+# at most one traceback of internal serving error is printed per this many
+# seconds, others are only counted
+ERROR_LOG_INTERVAL = 10
+# address prometheus metrics are served on (--metrics-port)
+METRICS_IP = '127.0.0.1'
 
 
 def write_in_file(*text):
@@ -25,6 +101,11 @@ class ResponseCode():
     REFUSED = 5
 
 
+class Classes():
+    IN = 1
+    CHAOS = 3
+
+
 class Types():
     A = 0x1
     NS = 0x2
@@ -33,6 +114,7 @@ class Types():
     MX = 0xF
     TXT = 0X10
     AAAA = 0X1C
+    OPT = 0x29  # EDNS0 pseudo record, not a query type
     reversed_types = {
         0x1: "A",
         0x2: "NS",
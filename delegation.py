@@ -0,0 +1,73 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+from constants import DELEGATION_CACHE_MAX_ENTRIES
+
+
+# all suffixes of domain name from itself up to root ('')
+# 'www.example.com.' -> 'www.example.com.', 'example.com.', 'com.', ''
+def name_suffixes(name):
+    name = name.lower()
+    suffixes = []
+    while name:
+        suffixes.append(name)
+        name = name[name.find('.') + 1:]
+    suffixes.append('')
+    return suffixes
+
+
+# cache of zone cuts (zone: name server names) and of name server addresses
+# learned from referrals, entries expire with ttl of their records
+class DelegationCache():
+
+    def __init__(self, max_entries=DELEGATION_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.zones = OrderedDict()  # zone: (ns names, expires at)
+        self.addresses = OrderedDict()  # ns name: (ips, expires at)
+        self.lock = threading.Lock()
+
+    def _put(self, table, key, value, time_to_leave):
+        if time_to_leave <= 0:
+            return
+        with self.lock:
+            table[key] = (value, monotonic() + time_to_leave)
+            table.move_to_end(key)
+            while len(table) > self.max_entries:
+                table.popitem(last=False)
+
+    def _get(self, table, key, now):
+        item = table.get(key)
+        if item is None:
+            return None
+        if item[1] <= now:
+            with self.lock:
+                table.pop(key, None)
+            return None
+        return item[0]
+
+    def add_delegation(self, zone, ns_names, time_to_leave):
+        self._put(self.zones, zone.lower(), tuple(ns_names), time_to_leave)
+
+    def add_addresses(self, ns_name, ips, time_to_leave):
+        self._put(self.addresses, ns_name.lower(), tuple(ips), time_to_leave)
+
+    def get_addresses(self, ns_name):
+        return self._get(self.addresses, ns_name.lower(), monotonic()) or ()
+
+    # cached zone cuts enclosing name, deepest first, as (zone, ns names)
+    def enclosing(self, name):
+        now = monotonic()
+        cuts = []
+        for suffix in name_suffixes(name):
+            ns_names = self._get(self.zones, suffix, now)
+            if ns_names:
+                cuts.append((suffix, ns_names))
+        return cuts
+
+    # (zone cuts, name server addresses) as lists of (key, (value, expires at))
+    def items(self):
+        with self.lock:
+            return list(self.zones.items()), list(self.addresses.items())
+
+    def __len__(self):
+        return len(self.zones)
@@ -1,212 +1,560 @@
+import asyncio
+import selectors
 import socket
-import threading
-from parser import DNSMessageParser
-from struct import pack, unpack
-from time import time
-from builder import DNSMessageBuilder
-from constants import (MSG_MAX_SIZE, MSG_SIZE, ROOT_SERVER_IPS, Types,
-                       random_id, write_in_file)
+import traceback
+from parser import DNSMessageParser, DNSParseError
+from struct import error as struct_error
+from struct import pack, unpack, unpack_from
+from time import monotonic, perf_counter
+from admission import SEND, SLIP
+from async_server import DNSDatagramProtocol, DNSStreamProtocol
+from builder import (BADVERS_OPT_RECORD, OPT_RECORD, DNSMessageBuilder,
+                     fit_response, truncate_response)
+from cache import ResolverCache
+from metrics import Metrics
+from resolver import Resolver, upstream_queries
+from constants import (ERROR_LOG_INTERVAL, MAX_IN_FLIGHT, MAX_QUEUED_RECURSION, MSG_MAX_SIZE,
+                       STALE_ANSWER_TIMEOUT, STATS_NAME, TCP_IDLE_TIMEOUT, TCP_MSG_MAX_SIZE,
+                       Classes, ResponseCode, Types)
+from zone_index import ZoneIndex
 
 
 class DNSServer:
 
-    def __init__(self, ip, port, zones=[]):
+    def __init__(self, ip, port, zones=[], max_in_flight=MAX_IN_FLIGHT, reuse_port=False,
+                 zone_index=None, cache=None, resolver=None, metrics=None,
+                 max_queued=MAX_QUEUED_RECURSION, shed_rcode=ResponseCode.SERVER_FAILURE,
+                 client_limiter=None, response_limiter=None, query_log=None):
         self.ip = ip
         self.port = port
-        self._init_socket()
+        self.reuse_port = reuse_port
+        self._init_socket(reuse_port)
         self.zones = zones
-        self.thread_pool = []
+        # precompiled zone answers, can be built once and shared by workers
+        self.zone_index = zone_index if zone_index is not None else ZoneIndex(zones)
         self.shut_down = False
-        # contains domain:response pairs
-        self.cache = {}  # TODO make cache global and  thread safe
-        # save all name servers with (domain_name, querty type, nameserver ip)
-        # if name server  returned answer it is already saved in cache
-        # this for recursion not to be infinite
-        self.bed_name_servers = set()
-
-    def _init_socket(self):
+        # serial mode: written by shut_down_server to wake selector up
+        self.wakeup_socket = None
+        # event loop running upstream queries, in serial mode requests
+        # are driven through it one by one
+        self.loop = asyncio.new_event_loop()
+        # limit of recursive lookups running at once in async mode
+        self.max_in_flight = max_in_flight
+        self.in_flight_limit = None
+        self.tasks = set()
+        self.in_flight_peak = 0
+        # recursive lookups waiting for in-flight slot, over it they are
+        # answered at once with shed_rcode (or stale answer)
+        self.max_queued = max_queued
+        self.shed_rcode = shed_rcode
+        # udp clients only, tcp clients can not spoof their address
+        # ClientRateLimiter: queries per client prefix, over limit dropped
+        # ResponseRateLimiter: identical responses per client prefix
+        self.client_limiter = client_limiter
+        self.response_limiter = response_limiter
+        # QueryLog of answered queries, None when disabled
+        self.query_log = query_log
+        # prefetches and resolutions that go on after stale answer was sent
+        self.background_tasks = set()
+        # (domain, query type): response, bounded and thread safe
+        self.cache = cache if cache is not None else ResolverCache()
+        self.cache.on_prefetch = self._schedule_prefetch
+        # counters and histograms, readable with stats.bind query
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.metrics.add_collector(self._collect_metrics)
+        # when traceback of internal error was last printed
+        self.error_logged_at = None
+        # recursion state (delegations) lives in resolver
+        self.resolver = resolver if resolver is not None else Resolver(
+            self.cache, metrics=self.metrics)
+
+    def _init_socket(self, reuse_port=False):
         #  crate UDP socket
         self.dns_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         # make reuseable
         self.dns_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # several worker processes bind same address,
+            # kernel spreads datagrams between them
+            self.dns_socket.setsockopt(
+                socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.dns_socket.bind((self.ip, self.port))
 
-    def _lookup_cache(self, name, qtype_code):
-        # just check if name and query type is in cache and return it
-        # TODO add  time to leave
-        if (name, qtype_code) in self.cache:
-            cache_res, time_to_leave =  self.cache[(name, qtype_code)]
-            if time_to_leave >= time():
-                return cache_res
-        return None
+    # tcp listener of serial mode, async mode lets event loop create its own
+    def _init_tcp_socket(self):
+        tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        tcp_socket.bind((self.ip, self.port))
+        tcp_socket.listen(socket.SOMAXCONN)
+        # client that went away before accept does not block serving
+        tcp_socket.setblocking(False)
+        return tcp_socket
 
-    def _ask_server(self, server_ip, message, message_id):
-        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        udp_socket.sendto(message, (server_ip, 53))
-        udp_socket.settimeout(1)  # set timeout for name server response
+    # cached response with asker's request id and remaining ttls
+    def _lookup_cache(self, name, qtype_code, request_id):
+        return self.cache.get(name, qtype_code, request_id)
+
+    # recursive lookup for domain name and type,
+    # starts at closest cached zone cut, see Resolver.resolve
+    # if resolution fails, or is not done in STALE_ANSWER_TIMEOUT, expired
+    # cache entry is answered (RFC 8767), slow resolution goes on in background
+    # returns (response, 'recursive' or 'stale', upstream queries sent so far)
+    async def _lookup_recursive(self, name, qtype_code, request_id):
+        counter = [0]
+        token = upstream_queries.set(counter)
         try:
-            server_response, _ = udp_socket.recvfrom(
-                MSG_MAX_SIZE)  # (MSG_SIZE)
-            if server_response:
-                parsed_response = DNSMessageParser(server_response)
-                # check responde id if is correct
-                if parsed_response.request_id == message_id:
-                    return server_response, parsed_response
-        except:
-            pass
+            resolution = asyncio.ensure_future(
+                self.resolver.resolve(name, qtype_code, request_id))
         finally:
-            udp_socket.close()
-        return None, None
+            upstream_queries.reset(token)
+        if self.cache.stale_ttl:
+            done, _ = await asyncio.wait({resolution}, timeout=STALE_ANSWER_TIMEOUT)
+            if not done:
+                stale_response = self.cache.get_stale(name, qtype_code, request_id)
+                if stale_response:
+                    self._add_background_task(resolution)
+                    self.metrics.incr('dns_stale_answers_total')
+                    return stale_response, 'stale', counter[0]
+        try:
+            response = await resolution
+        except Exception:
+            self._internal_error()
+            response = None
+        if not response:
+            stale_response = self.cache.get_stale(name, qtype_code, request_id)
+            if stale_response:
+                self.metrics.incr('dns_stale_answers_total')
+                return stale_response, 'stale', counter[0]
+        return response, 'recursive', counter[0]
 
-    # build recursion desired request for root or name servers
-    def _build_rd_query(self, name, qtype_code, request_id):
-        builder = DNSMessageBuilder(request_id)
-        builder.build_flags()
-        builder.build_head(1, 0, 0, 0)
-        builder.build_query(name, qtype_code, 1)
-        return builder.message
+    def _add_background_task(self, task):
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
 
-    # recursive lookup for domain name and type
-    # first,  the function lookups in local cashe
-    # if not found then goes to global servers with ipv4 (TODO ipv6 support)
-    # if return response contains proper answer response is returned
-    # if not lookup for ips of name servers in server response message
-    # and sends query to them
-    def _lookup_recursive(self, name, qtype_code, request_id, message, server_ips=ROOT_SERVER_IPS):
-        cache_res = self._lookup_cache(name, qtype_code)
-        if cache_res is not None:
-            return cache_res
-
-        for server_ip in server_ips:
-            if (name, qtype_code, server_ip) in self.bed_name_servers:
-                break
-            self.bed_name_servers.add((name, qtype_code, server_ip))
-
-            server_response, parsed_server_response = self._ask_server(
-                server_ip, message, request_id)
-            # if receive something # and is not trucated
-            if server_response is not None and parsed_server_response.tc != 1:
-                if parsed_server_response.count_answers > 0:
-                    time_to_leave = parsed_server_response.answers[0].time_to_leave + time()
-                    self.cache[(name, qtype_code)] = (server_response , time_to_leave)
-                    return server_response
-
-                for auth in parsed_server_response.authorities:
-                    # check if it is authoritive name server
-                    if auth.rtype == Types.NS:
-                        found = False
-                        # search  for name server ip in additional result set data
-                        for addit in parsed_server_response.additions:
-                            if auth.rdata == addit.name:
-                                found = True
-                                if addit.rtype == Types.A:  # found ip v4
-                                    ip = addit.rdata
-                                    res_message = self._lookup_recursive(
-                                        name, qtype_code, request_id, message, [ip])
-                                    if res_message:
-                                        return res_message
-                                # break #not nessesary, nameservers can have multiple ips
-                        if not found:
-                            new_id = random_id()  # new random 16 bit id for query
-                            new_message = self._build_rd_query(
-                                auth.rdata, Types.A, new_id)
-                            # look up for name server ips
-                            res_message = self._lookup_recursive(
-                                auth.rdata, Types.A, new_id, new_message)
-                            if res_message:
-                                parsed = DNSMessageParser(res_message)
-                                # get name servers ips from retrurned response
-                                ips = [
-                                    answer.rdata for answer in parsed.answers if answer.rtype == Types.A]
-                                # continue recursive look up and send queries to authority name servers
-                                res_message = self._lookup_recursive(
-                                    name, qtype_code, request_id, message, ips)
-                                if res_message:
-                                    return res_message
-            else:
-                continue
+    # called by cache when hot entry is about to expire,
+    # resolves it again so next askers do not wait for recursion
+    def _schedule_prefetch(self, name, qtype_code):
+        self._add_background_task(self.loop.create_task(self._prefetch(name, qtype_code)))
 
-        return None
+    async def _prefetch(self, name, qtype_code):
+        # not counted as upstream queries of query that triggered it
+        upstream_queries.set(None)
+        self.metrics.incr('dns_cache_prefetches_total')
+        try:
+            await self.resolver.resolve(name, qtype_code, 0, refresh=True)
+        except Exception:
+            self._internal_error()
+
+    # swap in reloaded zones, lookups already running finish with old index
+    def set_zone_index(self, zone_index):
+        self.zone_index = zone_index
 
     #  look up in zone files
-    # return proper answever or authoritive nameserver if
-    # there is record about that domain name
+    # return answer, NXDOMAIN/NODATA with SOA or referral if name is in our zones
     def _lookup_zone(self, name, qtype_code, request_id):
-        qtype_str = Types.reversed_types[qtype_code]
-        for zone in self.zones:
-            # check if we have record for domain name
-            if name in zone.get_names().keys():
-                builder = DNSMessageBuilder(request_id)
-                # flags for response and authoritive answer
-                builder.build_flags(qr=1, aa=1)
-                try:
-                    # try to get domain name with query type
-                    answer_datas = zone.get_names()[name].records(
-                        qtype_str).get_items()
-                    builder.build_head(1, len(answer_datas), 0, 0)
-                except:
-                    # zones has no record about domain name with that qtype
-                    # so then return SOA record
-                    qtype_code = 6
-                    qtype_str = 'SOA'
-                    answer_datas = zone.get_names()[name].records(
-                        qtype_str).get_items()
-
-                    builder.build_head(1, 0, len(answer_datas), 0)
-
-                builder.build_query(name, qtype_code, 1)
-
-                for data in answer_datas:
-                    builder.build_answer(name, qtype_code, 1, 0, data)
-                return builder.message
-        return None
+        return self.zone_index.lookup(name, qtype_code, request_id)
+
+    # answers that do not need network: zone files and local cache
+    # returns (response or None, 'zone' or 'cache')
+    def _lookup_local(self, name, qtype_code, request_id):
+        zone_response = self._lookup_zone(name, qtype_code, request_id)
+        if zone_response:
+            self.metrics.incr('dns_zone_hits_total')
+            return zone_response, 'zone'
+        cache_response = self._lookup_cache(name, qtype_code, request_id)
+        if cache_response:
+            self.metrics.incr('dns_cache_hits_total')
+        else:
+            self.metrics.incr('dns_cache_misses_total')
+        return cache_response, 'cache'
+
+    # CHAOS class TXT stats.bind: one TXT record per metric
+    def _lookup_chaos(self, parsed_message):
+        question = parsed_message.questions[0]
+        if question.name.lower() != STATS_NAME or question.qtype != Types.TXT:
+            return self._build_error_response(parsed_message, ResponseCode.REFUSED)
+        lines = self.metrics.summary()
+        builder = DNSMessageBuilder(parsed_message.request_id)
+        builder.build_flags(qr=1, aa=1, rd=parsed_message.rd)
+        builder.build_head(1, len(lines), 0, 0)
+        builder.build_query(question.name, Types.TXT, Classes.CHAOS)
+        for line in lines:
+            builder.build_answer(question.name, Types.TXT, Classes.CHAOS, 0, line)
+        return builder.message
 
     # first lookup into local zone files and
     # then try to find answer from root servers
-    def _process_question(self, question, request_id, parser):
+    # returns (response, source, upstream queries)
+    async def _process_question(self, question, request_id, parser):
         name = question.name
         qtype_code = question.qtype
-        # qclass = question.qclass # not used
-        zone_response = self._lookup_zone(name, qtype_code, request_id)
-        if zone_response:
-            return zone_response
+        if question.qclass == Classes.CHAOS:
+            return self._lookup_chaos(parser), 'chaos', 0
+        local_response, source = self._lookup_local(name, qtype_code, request_id)
+        if local_response:
+            return local_response, source, 0
 
         # not found in zone files
         # try to get recursive  from local cache
         # or from root name servers
-        # message = self._build_rd_query(name,qtype_code,request_id)
-        return self._lookup_recursive(name, qtype_code, request_id, parser.request)
+        return await self._lookup_recursive(name, qtype_code, request_id)
+
+    @staticmethod
+    def _build_error_response(parsed_message, rcode):
+        builder = DNSMessageBuilder(parsed_message.request_id)
+        builder.build_flags(qr=1, rd=parsed_message.rd, rcode=rcode)
+        builder.build_head(1, 0, 0, 0)
+        question = parsed_message.questions[0]
+        builder.build_query(question.name, question.qtype, question.qclass)
+        return builder.message
+
+    # largest udp response client accepts and OPT record to add to response,
+    # EDNS0 clients get our OPT back (BADVERS for versions other than 0)
+    @staticmethod
+    def _response_limits(parsed_message):
+        edns = parsed_message.edns
+        max_size = min(parsed_message.udp_payload_size(), MSG_MAX_SIZE)
+        if edns is None:
+            return max_size, None
+        return max_size, OPT_RECORD if edns.version == 0 else BADVERS_OPT_RECORD
+
+    # parse client query header and question, parse time goes to metrics
+    # returns None if message can not be parsed or has no question,
+    # it is only counted, anyone can send such datagrams
+    def _parse_query(self, received_message):
+        started = perf_counter()
+        try:
+            parsed_message = DNSMessageParser(received_message, lazy=True)
+            # decoded here so it counts as parse time
+            if not parsed_message.questions:
+                raise DNSParseError('query without question')
+        except (ValueError, IndexError, struct_error):
+            self.metrics.incr('dns_malformed_queries_total')
+            return None
+        self.metrics.observe('dns_parse_seconds', perf_counter() - started)
+        self.metrics.incr('dns_queries_total')
+        return parsed_message
+
+    # traceback of error in serving code, rate limited so failures repeated
+    # for every query do not flood stderr and slow serving down
+    def _internal_error(self):
+        self.metrics.incr('dns_internal_errors_total')
+        now = monotonic()
+        if self.error_logged_at is None or now - self.error_logged_at >= ERROR_LOG_INTERVAL:
+            self.error_logged_at = now
+            traceback.print_exc()
 
-    def _handle_request(self, address, received_message):
-        parsed_message = DNSMessageParser(received_message)
-        # for question in parsed_message.query_questions:  # TODO support for several questions
-        response = self._process_question(
-            parsed_message.questions[0], parsed_message.request_id, parsed_message)
-        self.dns_socket.sendto(response, address)
+    # EDNS0 version we do not speak: response without records, with BADVERS
+    # in OPT (RFC 6891 6.1.3), None for other queries
+    def _badvers_response(self, parsed_message, max_size, opt):
+        if opt is not BADVERS_OPT_RECORD:
+            return None
+        return self._finish_response(self._build_error_response(
+            parsed_message, ResponseCode.NO_ERROR), max_size, opt)
 
+    # fit response to client limits, build time goes to metrics
+    def _finish_response(self, response, max_size, opt):
+        started = perf_counter()
+        response = fit_response(response, max_size, opt)
+        self.metrics.observe('dns_build_seconds', perf_counter() - started)
+        return response
+
+    # udp query from address is within client rate limit
+    def _admit(self, address):
+        if self.client_limiter is None or self.client_limiter.allow(address[0]):
+            return True
+        self.metrics.incr('dns_shed_total', labels=(('reason', 'client_rate'),))
+        return False
+
+    # response rate limiting of udp response, None if it is dropped
+    def _limit_response(self, address, question, response):
+        if self.response_limiter is None:
+            return response
+        action = self.response_limiter.check(
+            address[0], question.name.lower(), question.qtype, response[3] & 0xF)
+        if action == SEND:
+            return response
+        if action == SLIP:
+            self.metrics.incr('dns_shed_total', labels=(('reason', 'rrl_slip'),))
+            return truncate_response(response)
+        self.metrics.incr('dns_shed_total', labels=(('reason', 'rrl_drop'),))
+        return None
+
+    # one line of query log for answered query, if logging is on
+    def _log_query(self, client, question, response, source, started, upstream=0):
+        if self.query_log is not None:
+            self.query_log.log(client, question.name, question.qtype, response[3] & 0xF,
+                               source, perf_counter() - started, upstream)
+
+    # serial mode: answer one query, send(response) sends it back,
+    # max_size is given for tcp, udp responses are rate limited
+    # returns False if message can not be parsed
+    def _handle_request(self, address, received_message, send, max_size=None):
+        started = perf_counter()
+        parsed_message = self._parse_query(received_message)
+        if parsed_message is None:
+            return False
+        udp_max_size, opt = self._response_limits(parsed_message)
+        udp = max_size is None
+        max_size = max_size or udp_max_size
+        question = parsed_message.questions[0]
+        response = self._badvers_response(parsed_message, max_size, opt)
+        if response is None:
+            # for question in parsed_message.query_questions:  # TODO support for several questions
+            try:
+                response, source, upstream = self.loop.run_until_complete(
+                    self._process_question(question, parsed_message.request_id,
+                                           parsed_message))
+            except Exception:
+                self._internal_error()
+                response, source, upstream = None, 'recursive', 0
+            if not response:
+                self.metrics.incr('dns_servfail_total')
+                response = self._build_error_response(
+                    parsed_message, ResponseCode.SERVER_FAILURE)
+            response = self._finish_response(response, max_size, opt)
+        else:
+            source = None
+        if udp:
+            response = self._limit_response(address, question, response)
+        if response:
+            send(response)
+            if source is not None:
+                self._log_query(address[0], question, response, source, started, upstream)
+        # prefetches run after client got its answer, before next query
+        if self.background_tasks:
+            self.loop.run_until_complete(asyncio.wait(list(self.background_tasks)))
+        return True
+
+    def _serve_datagram(self):
+        received_message, address = self.dns_socket.recvfrom(MSG_MAX_SIZE)
+        if not self._admit(address):
+            return
+        try:
+            self._handle_request(address, received_message,
+                                 lambda response: self.dns_socket.sendto(response, address))
+        except Exception:
+            # query is dropped, server goes on
+            self._internal_error()
+
+    # length prefixed queries received on tcp connection, answered in order
+    # returns False if connection is to be closed
+    def _serve_connection(self, connection, state):
+        try:
+            data = connection.recv(TCP_MSG_MAX_SIZE)
+        except OSError:
+            return False
+        if not data:
+            return False
+        buffer, address = state[0], state[2]
+        buffer += data
+        state[1] = monotonic()
+        while len(buffer) >= 2:
+            length = unpack_from('!H', buffer)[0]
+            if len(buffer) < 2 + length:
+                break
+            message = bytes(buffer[2:2 + length])
+            del buffer[:2 + length]
+            try:
+                if not self._handle_request(
+                        address, message,
+                        lambda response: connection.sendall(pack('!H', len(response)) + response),
+                        TCP_MSG_MAX_SIZE):
+                    return False
+            except OSError:
+                # client is gone or does not read its answers
+                return False
+            except Exception:
+                self._internal_error()
+        return True
+
+    # serial mode: one query at a time, from udp socket or tcp connections
+    # (clients retry answers truncated in udp over tcp)
     def start_server(self):
-        while True:
-            # if self.shut_down:
-            #     # if server received shut down
-            #     self._stop_threads()
-            #     return
-            received_message, address = self.dns_socket.recvfrom(MSG_SIZE)
-            # if server received nothing then exit
-            # if len(received_message) == 0:
-            #     return
-
-            self._handle_request(address, received_message)
-
-            # # handle each reques in threads
-            # thread = threading.Thread(
-            #     target=self._handle_request, args=(address, received_message))
-            # self.thread_pool.append(thread)
-            # thread.start()
+        tcp_socket = self._init_tcp_socket()
+        selector = selectors.DefaultSelector()
+        selector.register(self.dns_socket, selectors.EVENT_READ)
+        selector.register(tcp_socket, selectors.EVENT_READ)
+        wakeup_reader, self.wakeup_socket = socket.socketpair()
+        self.wakeup_socket.setblocking(False)
+        selector.register(wakeup_reader, selectors.EVENT_READ)
+        # tcp connection: [received bytes, last activity, client address]
+        connections = {}
+        try:
+            while not self.shut_down:
+                for key, _ in selector.select(TCP_IDLE_TIMEOUT):
+                    if key.fileobj is self.dns_socket:
+                        self._serve_datagram()
+                    elif key.fileobj is wakeup_reader:
+                        wakeup_reader.recv(64)
+                    elif key.fileobj is tcp_socket:
+                        try:
+                            connection, address = tcp_socket.accept()
+                        except OSError:
+                            continue
+                        # blocks sending answer to slow client at most so long
+                        connection.settimeout(TCP_IDLE_TIMEOUT)
+                        connections[connection] = [bytearray(), monotonic(), address]
+                        selector.register(connection, selectors.EVENT_READ)
+                    elif not self._serve_connection(key.fileobj, connections[key.fileobj]):
+                        selector.unregister(key.fileobj)
+                        del connections[key.fileobj]
+                        key.fileobj.close()
+                now = monotonic()
+                for connection, state in list(connections.items()):
+                    if now - state[1] >= TCP_IDLE_TIMEOUT:
+                        selector.unregister(connection)
+                        del connections[connection]
+                        connection.close()
+        finally:
+            for connection in connections:
+                connection.close()
+            selector.close()
+            tcp_socket.close()
+            wakeup_reader.close()
+            self.wakeup_socket.close()
+            self.wakeup_socket = None
 
+    # async mode: zone and cache hits are answered inline on the event loop,
+    # recursive lookups run as concurrent tasks
+    # reply(response) sends response back over udp or tcp, max_size is given
+    # for tcp, for udp it comes from client EDNS0 payload size
+    # address of client, responses to udp clients (no max_size) are rate limited
+    # returns False if message can not be parsed
+    def _handle_query(self, received_message, reply, max_size=None, address=None):
+        started = perf_counter()
+        try:
+            parsed_message = self._parse_query(received_message)
+            if parsed_message is None:
+                return False
+            question = parsed_message.questions[0]
+            if max_size is None and address is not None and self.response_limiter is not None:
+                reply = self._limited_reply(reply, address, question)
+            udp_max_size, opt = self._response_limits(parsed_message)
+            max_size = max_size or udp_max_size
+            response = self._badvers_response(parsed_message, max_size, opt)
+            if response is not None:
+                reply(response)
+                return True
+            if question.qclass == Classes.CHAOS:
+                response, source = self._lookup_chaos(parsed_message), 'chaos'
+            else:
+                response, source = self._lookup_local(
+                    question.name, question.qtype, parsed_message.request_id)
+        except Exception:
+            self._internal_error()
+            return False
+        client = address[0] if address is not None else None
+        if response:
+            response = self._finish_response(response, max_size, opt)
+            reply(response)
+            self._log_query(client, question, response, source, started)
+            return True
+        if len(self.tasks) >= self.max_in_flight + self.max_queued:
+            # recursion budget is used up: answer now instead of queueing
+            self.metrics.incr('dns_shed_total', labels=(('reason', 'recursion_queue'),))
+            response = self.cache.get_stale(
+                question.name, question.qtype, parsed_message.request_id)
+            source = 'stale' if response else 'shed'
+            response = self._finish_response(
+                response or self._build_error_response(parsed_message, self.shed_rcode),
+                max_size, opt)
+            reply(response)
+            self._log_query(client, question, response, source, started)
+            return True
+        task = self.loop.create_task(
+            self._resolve_query(parsed_message, reply, max_size, opt, client, started))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        self.in_flight_peak = max(self.in_flight_peak, len(self.tasks))
+        return True
+
+    def _limited_reply(self, reply, address, question):
+        def limited_reply(response):
+            response = self._limit_response(address, question, response)
+            if response:
+                reply(response)
+        return limited_reply
+
+    def _handle_datagram(self, transport, address, received_message):
+        if not self._admit(address):
+            return
+        self._handle_query(received_message,
+                           lambda response: transport.sendto(response, address),
+                           address=address)
+
+    async def _resolve_query(self, parsed_message, reply, max_size, opt, client=None,
+                             received=None):
+        question = parsed_message.questions[0]
+        response, source, upstream = None, 'recursive', 0
+        started = perf_counter()
+        try:
+            async with self.in_flight_limit:
+                response, source, upstream = await self._lookup_recursive(
+                    question.name, question.qtype, parsed_message.request_id)
+        except Exception:
+            self._internal_error()
+        self.metrics.observe('dns_resolve_seconds', perf_counter() - started)
+        if not response:
+            self.metrics.incr('dns_servfail_total')
+            response = self._build_error_response(
+                parsed_message, ResponseCode.SERVER_FAILURE)
+        response = self._finish_response(response, max_size, opt)
+        reply(response)
+        self._log_query(client, question, response, source, received or started, upstream)
+
+    # gauges read from server state when metrics are exported
+    def _collect_metrics(self, metrics):
+        metrics.set('dns_zones', self.zone_index.zone_count)
+        metrics.set('dns_zone_answers', self.zone_index.answer_count)
+        metrics.set('dns_cache_entries', len(self.cache))
+        metrics.set_total('dns_cache_evictions_total', self.cache.evictions)
+        metrics.set('dns_recursion_in_flight', len(self.tasks))
+        metrics.set('dns_recursion_in_flight_peak', self.in_flight_peak)
+        metrics.set('dns_recursion_queued', max(0, len(self.tasks) - self.max_in_flight))
+        metrics.set('dns_resolutions_in_flight', len(self.resolver.in_flight))
+        metrics.set('dns_background_tasks', len(self.background_tasks))
+        if self.query_log is not None:
+            metrics.set_total('dns_query_log_written_total', self.query_log.written)
+            metrics.set_total('dns_query_log_dropped_total', self.query_log.dropped)
+        stats = self.resolver.upstream.stats
+        metrics.set_histogram('dns_upstream_rtt_seconds', stats.rtts)
+        for server_ip, state in list(stats.servers.items()):
+            labels = (('server', server_ip),)
+            metrics.set('dns_upstream_srtt_seconds', state.srtt, labels)
+            metrics.set_total('dns_upstream_replies_total', state.replies, labels)
+            metrics.set_total('dns_upstream_failures_total', state.failures, labels)
+            metrics.set('dns_upstream_error_rate', state.error_rate, labels)
+
+    async def _start_async_endpoint(self):
+        self.in_flight_limit = asyncio.Semaphore(self.max_in_flight)
+        self.dns_socket.setblocking(False)
+        self.transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: DNSDatagramProtocol(self), sock=self.dns_socket)
+        # tcp listener on same port for answers that do not fit in udp
+        self.tcp_server = await self.loop.create_server(
+            lambda: DNSStreamProtocol(self), self.ip, self.port,
+            reuse_address=True, reuse_port=self.reuse_port or None)
+
+    def start_async_server(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._start_async_endpoint())
+        try:
+            self.loop.run_forever()
+        finally:
+            self.transport.close()
+            self.tcp_server.close()
+
+    # safe to call from signal handler, serial mode ends after query
+    # being answered, async mode stops its event loop
     def shut_down_server(self):
         self.shut_down = True
-
-    # wait for thread to finish their work
-    def _stop_threads(self):
-        for thread in self.thread_pool:
-            thread.join()
+        if self.wakeup_socket is not None:
+            try:
+                self.wakeup_socket.send(b'\0')
+            except OSError:
+                pass
+        elif self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
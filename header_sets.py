@@ -1,10 +1,12 @@
 class ResultSet():
-    def __init__(self, name, rtype, rclass, time_to_leave, rdata):
+    def __init__(self, name, rtype, rclass, time_to_leave, rdata, ttl_index=None):
         self.name = name
         self.rtype = rtype
         self.rclass = rclass
         self.time_to_leave = time_to_leave
         self.rdata = rdata
+        # position of ttl field in message, used to rewrite cached ttls
+        self.ttl_index = ttl_index
         # self.rdata_length = rdata_length
         # self.last_byte_index = last_byte_index
         # self.byte_message = b''
@@ -13,4 +15,12 @@ class QuestionSet():
     def __init__(self, name, qtype, qclass):
         self.name = name
         self.qtype = qtype
-        self.qclass = qclass
\ No newline at end of file
+        self.qclass = qclass
+
+# EDNS0 values carried by OPT pseudo record (RFC 6891)
+class EdnsSet():
+    def __init__(self, udp_payload_size, extended_rcode, version, dnssec_ok):
+        self.udp_payload_size = udp_payload_size
+        self.extended_rcode = extended_rcode
+        self.version = version
+        self.dnssec_ok = dnssec_ok
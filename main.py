@@ -1,30 +1,196 @@
+import argparse
+import signal
 import sys
 import dns_server
 import os
-import traceback
-from easyzone import easyzone
-from constants import ZONE_FILE_EXT
+import workers
+from admission import ClientRateLimiter, ResponseRateLimiter
+from cache import ResolverCache
+from cache_store import CacheSnapshotWriter, load_cache_snapshot
+from metrics import Metrics, start_metrics_server
+from query_log import QueryLog
+from resolver import Resolver
+from zone_store import ZoneStore
+from constants import (CACHE_MAX_BYTES, CACHE_MAX_ENTRIES, CACHE_PREFETCH_HITS,
+                       CACHE_SNAPSHOT_INTERVAL, CACHE_STALE_TTL, MAX_IN_FLIGHT,
+                       MAX_QUEUED_RECURSION, METRICS_IP, QUERY_LOG_MAX_BYTES,
+                       ROOT_SERVER_IPS, RRL_SLIP, UPSTREAM_PORT, UPSTREAM_RACE,
+                       ZONE_SNAPSHOT_FILE, ResponseCode)
 
+SERVER_MODES = ('serial', 'async')
+SHED_RCODES = {'servfail': ResponseCode.SERVER_FAILURE, 'refused': ResponseCode.REFUSED}
 
-def load_zones(config_dir):
-    zones_list = []  # {zone_info}
+
+# --forward-zone ZONE=IP,IP
+def forward_rule(text):
+    zone, _, server_ips = text.partition('=')
+    if not server_ips:
+        raise argparse.ArgumentTypeError('expected ZONE=IP[,IP...]')
+    return zone, server_ips.split(',')
+
+
+# optional flags given after CONFIG IP PORT
+def parse_options(args):
+    arg_parser = argparse.ArgumentParser(prog='main.py CONFIG IP PORT')
+    arg_parser.add_argument('--mode', choices=SERVER_MODES, default='serial',
+                            help='serial recvfrom loop or asyncio engine')
+    arg_parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT,
+                            help='max concurrent recursive lookups (async mode)')
+    arg_parser.add_argument('--max-queued', type=int, default=MAX_QUEUED_RECURSION,
+                            help='recursive lookups waiting for a slot, more are answered '
+                                 'at once with --shed-rcode (async mode)')
+    arg_parser.add_argument('--shed-rcode', choices=sorted(SHED_RCODES), default='servfail',
+                            help='answer to queries shed when recursion is overloaded')
+    arg_parser.add_argument('--client-rate', type=float, default=0,
+                            help='udp queries per second allowed per client /24 (/56), '
+                                 'others are dropped (0 disables)')
+    arg_parser.add_argument('--client-burst', type=int, default=None,
+                            help='queries client prefix may send at once (default rate)')
+    arg_parser.add_argument('--rrl', type=float, default=0,
+                            help='identical udp responses per second per client prefix, '
+                                 'others are dropped or slipped (0 disables)')
+    arg_parser.add_argument('--rrl-slip', type=int, default=RRL_SLIP,
+                            help='every N-th rate limited response is sent truncated '
+                                 '(0 drops all)')
+    arg_parser.add_argument('--cache-entries', type=int, default=CACHE_MAX_ENTRIES,
+                            help='max responses kept in resolver cache')
+    arg_parser.add_argument('--cache-bytes', type=int, default=CACHE_MAX_BYTES,
+                            help='max memory used by resolver cache')
+    arg_parser.add_argument('--prefetch-hits', type=int, default=CACHE_PREFETCH_HITS,
+                            help='refresh cache entries asked N times before they expire '
+                                 '(0 disables)')
+    arg_parser.add_argument('--serve-stale', type=int, default=CACHE_STALE_TTL,
+                            help='answer from cache entries expired up to N seconds ago '
+                                 'when upstream fails or is slow (0 disables)')
+    arg_parser.add_argument('--cache-snapshot', default=None,
+                            help='dump resolver cache to file periodically and load it on '
+                                 'start (worker N uses PATH.N)')
+    arg_parser.add_argument('--cache-snapshot-interval', type=float,
+                            default=CACHE_SNAPSHOT_INTERVAL,
+                            help='seconds between cache snapshots')
+    arg_parser.add_argument('--race', type=int, default=UPSTREAM_RACE,
+                            help='ask N name servers at once, first valid reply wins')
+    arg_parser.add_argument('--workers', type=int, default=0,
+                            help='fork N server processes sharing port with SO_REUSEPORT')
+    # other root servers/port, e.g. local fake hierarchy of benchmark
+    arg_parser.add_argument('--root-servers', type=lambda ips: ips.split(','),
+                            default=ROOT_SERVER_IPS,
+                            help='comma separated root server addresses')
+    arg_parser.add_argument('--upstream-port', type=int, default=UPSTREAM_PORT,
+                            help='port name servers are asked on')
+    arg_parser.add_argument('--forward', type=lambda ips: ips.split(','), default=None,
+                            help='comma separated resolvers all names are forwarded to '
+                                 '(recursion desired) instead of iterating')
+    arg_parser.add_argument('--forward-zone', type=forward_rule, action='append', default=[],
+                            help='ZONE=IP,IP forwards names under zone to these resolvers, '
+                                 'can be repeated, longest zone wins over --forward')
+    arg_parser.add_argument('--forward-first', action='store_true',
+                            help='iterate from root servers when forwarders fail')
+    arg_parser.add_argument('--zone-snapshot', default=None,
+                            help='compiled zones file (default CONFIG/.zones.snapshot)')
+    arg_parser.add_argument('--no-zone-snapshot', action='store_true',
+                            help='compile zone files on every start')
+    arg_parser.add_argument('--watch-zones', type=float, default=0,
+                            help='check zone files for changes every N seconds '
+                                 '(SIGHUP reloads them anyway)')
+    arg_parser.add_argument('--query-log', default=None,
+                            help='json lines log of answered queries (worker N uses PATH.wN)')
+    arg_parser.add_argument('--query-log-sample', type=float, default=1.0,
+                            help='fraction of queries logged')
+    arg_parser.add_argument('--query-log-max-bytes', type=int, default=QUERY_LOG_MAX_BYTES,
+                            help='log is rotated at this size')
+    arg_parser.add_argument('--metrics-port', type=int, default=0,
+                            help='serve prometheus metrics and profiler on local port '
+                                 '(worker N uses port + N)')
+    return arg_parser.parse_args(args)
+
+
+def serve(zone_store, IP, PORT, options, reuse_port=False, worker_index=0):
+    # SIGHUP: changed zone files are compiled again, reload requested while
+    # server starts is done once zone watcher runs
+    signal.signal(signal.SIGHUP, lambda signum, frame: zone_store.request_reload())
+    if reuse_port:
+        # restarted worker picks up zones reloaded since fork
+        zone_store.load()
+    cache = ResolverCache(options.cache_entries, options.cache_bytes,
+                          prefetch_hits=options.prefetch_hits, stale_ttl=options.serve_stale)
+    metrics = Metrics()
+    forward_zones = dict(options.forward_zone)
+    if options.forward:
+        forward_zones[''] = options.forward
+    resolver = Resolver(cache, root_servers=options.root_servers,
+                        upstream_port=options.upstream_port,
+                        race=options.race, metrics=metrics,
+                        forward_zones=forward_zones, forward_only=not options.forward_first)
+    snapshot_writer = None
+    if options.cache_snapshot:
+        # warm start: answers and delegations of previous run, ttls moved by downtime
+        cache_snapshot = options.cache_snapshot if not reuse_port else \
+            f'{options.cache_snapshot}.{worker_index}'
+        loaded = load_cache_snapshot(cache_snapshot, cache, resolver.delegations)
+        print(f'{loaded} cache entries loaded from {cache_snapshot}')
+        snapshot_writer = CacheSnapshotWriter(cache_snapshot, cache, resolver.delegations,
+                                              options.cache_snapshot_interval)
+        snapshot_writer.start()
+    query_log = None
+    if options.query_log:
+        query_log = QueryLog(options.query_log if not reuse_port else
+                             f'{options.query_log}.w{worker_index}',
+                             options.query_log_sample,
+                             max_bytes=options.query_log_max_bytes)
+        query_log.start()
+    server = dns_server.DNSServer(IP, int(PORT),
+                                  max_in_flight=options.max_in_flight,
+                                  reuse_port=reuse_port, zone_index=zone_store.index,
+                                  cache=cache, resolver=resolver, metrics=metrics,
+                                  max_queued=options.max_queued,
+                                  shed_rcode=SHED_RCODES[options.shed_rcode],
+                                  client_limiter=ClientRateLimiter(
+                                      options.client_rate, options.client_burst)
+                                  if options.client_rate else None,
+                                  response_limiter=ResponseRateLimiter(
+                                      options.rrl, options.rrl_slip)
+                                  if options.rrl else None,
+                                  query_log=query_log)
+    # SIGTERM (also sent by worker supervisor) and SIGINT: server stops,
+    # query log and cache snapshot are saved below
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: server.shut_down_server())
+    if options.metrics_port:
+        start_metrics_server(metrics, METRICS_IP, options.metrics_port + worker_index)
+    # SIGHUP or changed zone files: changed files are compiled again
+    # and new zone index is swapped in
+    zone_store.listeners.append(server.set_zone_index)
+    zone_store.start_watcher(options.watch_zones or None)
     try:
-        for zone_file in os.listdir(config_dir):
-            path = os.path.join(config_dir, zone_file)
-            if os.path.isfile(path) and zone_file.find(ZONE_FILE_EXT) != -1:
-                domain_name = zone_file[:zone_file.rfind('.')]
-                zone_info = easyzone.zone_from_file(domain_name, path)
-                zones_list.append(zone_info)
-    except:
-        print(f'error ocuured while reading zone files in dir : {config_dir}')
-        traceback.print_exc()
-    return zones_list
-
-
-def run_dns_server(CONFIG, IP, PORT):
-    zones = load_zones(CONFIG)
-    server = dns_server.DNSServer(IP, int(PORT), zones)
-    server.start_server()
+        if options.mode == 'async':
+            server.start_async_server()
+        else:
+            server.start_server()
+    finally:
+        # buffered query log lines are written out,
+        # cache of this run is kept for next start
+        if query_log is not None:
+            query_log.close()
+        if snapshot_writer is not None:
+            snapshot_writer.stop()
+
+
+def run_dns_server(CONFIG, IP, PORT, options=None):
+    # options after CONFIG IP PORT on command line
+    if options is None:
+        options = parse_options(sys.argv[4:])
+    # zones are loaded once (from snapshot when zone files did not change),
+    # workers share them after fork
+    snapshot_path = None if options.no_zone_snapshot else \
+        options.zone_snapshot or os.path.join(CONFIG, ZONE_SNAPSHOT_FILE)
+    zone_store = ZoneStore(CONFIG, snapshot_path)
+    zone_store.load()
+    if options.workers > 0:
+        workers.run_workers(options.workers, lambda index: serve(
+            zone_store, IP, PORT, options, reuse_port=True, worker_index=index))
+    else:
+        serve(zone_store, IP, PORT, options)
 
 
 # do not change!
@@ -0,0 +1,229 @@
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# upper bounds (seconds) of latency histogram buckets
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+                   0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+# upper bounds of histograms of small counts (e.g. upstream queries per resolution)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 6, 8, 12, 16, 24, 32)
+# seconds between stack samples of profiler
+PROFILE_INTERVAL = 0.005
+
+
+# cumulative bucket counts as prometheus histogram has them
+class Histogram():
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # upper bound of bucket where fraction of observations is reached
+    def quantile(self, fraction):
+        if not self.count:
+            return None
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= fraction * self.count:
+                return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return float('inf')
+
+
+def _labels_text(labels, extra=()):
+    pairs = tuple(labels) + tuple(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{label}="{value}"' for label, value in pairs) + '}'
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(round(value, 9))
+    return str(value)
+
+
+# counters, gauges and histograms of one server process
+# series are keyed by (name, labels), labels is tuple of (label, value) pairs
+# plain dict updates, cheap enough for hot path; collectors fill gauges
+# from server state (cache size, upstream rtts, ...) when metrics are read
+class Metrics():
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.collectors = []
+
+    def incr(self, name, value=1, labels=()):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, labels=()):
+        self.gauges[(name, labels)] = value
+
+    # counter kept elsewhere (e.g. cache evictions), copied by collector
+    def set_total(self, name, value, labels=()):
+        self.counters[(name, labels)] = value
+
+    def set_histogram(self, name, histogram, labels=()):
+        self.histograms[(name, labels)] = histogram
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, labels=()):
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = Histogram(buckets)
+        histogram.observe(value)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def collect(self):
+        for collector in self.collectors:
+            collector(self)
+
+    # prometheus text exposition format
+    def prometheus(self):
+        self.collect()
+        lines = []
+        for kind, series in (('counter', self.counters), ('gauge', self.gauges)):
+            last_name = None
+            for (name, labels), value in sorted(list(series.items())):
+                if name != last_name:
+                    lines.append(f'# TYPE {name} {kind}')
+                    last_name = name
+                lines.append(f'{name}{_labels_text(labels)} {_number(value)}')
+        last_name = None
+        for (name, labels), histogram in sorted(list(self.histograms.items()),
+                                                key=lambda item: item[0]):
+            if name != last_name:
+                lines.append(f'# TYPE {name} histogram')
+                last_name = name
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',), list(histogram.counts)):
+                cumulative += count
+                lines.append(f'{name}_bucket{_labels_text(labels, (("le", bound),))} '
+                             f'{cumulative}')
+            lines.append(f'{name}_sum{_labels_text(labels)} {_number(histogram.sum)}')
+            lines.append(f'{name}_count{_labels_text(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    # one short line per series without labels (answer of stats query)
+    def summary(self):
+        self.collect()
+        lines = []
+        for series in (self.counters, self.gauges):
+            for (name, labels), value in sorted(list(series.items())):
+                if not labels:
+                    lines.append(f'{name} {_number(value)}')
+        for (name, labels), histogram in sorted(list(self.histograms.items()),
+                                                key=lambda item: item[0]):
+            if labels or not histogram.count:
+                continue
+            lines.append(f'{name} count={histogram.count} '
+                         f'mean={_number(histogram.sum / histogram.count)} '
+                         f'p50<={histogram.quantile(0.5)} p99<={histogram.quantile(0.99)}')
+        return lines
+
+
+# sampling profiler: background thread records stack of profiled thread
+# every interval, can be started and stopped while server runs
+# samples are collapsed stacks ('outer;inner' lines, flame graph input)
+class SamplingProfiler():
+
+    def __init__(self, thread_id=None, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id if thread_id is not None else threading.main_thread().ident
+        self.interval = interval
+        self.samples = Counter()
+        self.running = False
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return False
+            self.samples = Counter()
+            self.running = True
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+            return True
+
+    def stop(self):
+        with self.lock:
+            if not self.running:
+                return False
+            self.running = False
+            self.thread.join()
+            return True
+
+    def _run(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.samples.most_common())
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        metrics = self.server.metrics
+        profiler = self.server.profiler
+        if self.path == '/metrics':
+            body = metrics.prometheus()
+        elif self.path == '/profile/start':
+            body = 'profiler started\n' if profiler.start() else 'profiler already running\n'
+        elif self.path == '/profile/stop':
+            profiler.stop()
+            body = profiler.collapsed()
+        elif self.path == '/profile':
+            body = profiler.collapsed()
+        else:
+            self.send_error(404)
+            return
+        data = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _MetricsHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+# serve /metrics (prometheus text) and /profile[/start|/stop] on local port
+# from background thread, works in serial and async mode alike
+def start_metrics_server(metrics, ip, port, profiler=None):
+    http_server = _MetricsHTTPServer((ip, port), _MetricsRequestHandler)
+    http_server.metrics = metrics
+    http_server.profiler = profiler if profiler is not None else SamplingProfiler()
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    return http_server
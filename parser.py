@@ -1,34 +1,48 @@
 from ipaddress import IPv6Address
-from struct import unpack
-from constants import Types, write_in_file
-from header_sets import QuestionSet, ResultSet
+from struct import unpack_from
+from constants import MSG_SIZE, Types, write_in_file
+from header_sets import EdnsSet, QuestionSet, ResultSet
 
+# domain name can not be longer than 255 bytes on wire
+MAX_NAME_LENGTH = 255
 
+
+class DNSParseError(ValueError):
+    pass
+
+
+# parses dns message over memoryview of received bytes
+# sections are decoded when they are first accessed, so lazy parser of
+# client query decodes only header and question and parser of upstream reply
+# only sections resolver looks at
 class DNSMessageParser():
 
-    def __init__(self, request):
+    def __init__(self, request, lazy=False):
         self.request = request
+        self.view = memoryview(request)
         self.index = 0
         self.parse_header()
-        self.questions = [self.parse_question()
-                            for _ in range(self.count_questions)]
-        self.answers = [self.parse_answer()
-                            for _ in range(self.count_answers)]
-        self.authorities = [self.parse_authority()
-                            for _ in range(self.count_authorities)]
-        self.additions = [self.parse_additional()
-                            for _ in range(self.count_additional)]
-    
+        # start index of questions, answers, authorities, additions
+        # and end of message, known once previous section is walked
+        self._offsets = [self.index, None, None, None, None]
+        self._sections = [None, None, None, None]
+        self._edns = False  # not looked up yet
+        if not lazy:
+            for section in range(4):
+                self._parse_section(section)
+
     # parse 12 bytes long dns header
     def parse_header(self):
-        self.index += 12
-        self.request_id, self.flags, self.count_questions, self.count_answers, self.count_authorities, self.count_additional = unpack(
-            '!HHHHHH', self.request[:self.index])
+        if len(self.view) < 12:
+            raise DNSParseError('message shorter than header')
+        self.request_id, self.flags, self.count_questions, self.count_answers, self.count_authorities, self.count_additional = unpack_from(
+            '!HHHHHH', self.view, 0)
+        self.index = 12
         self._parse_flags()
 
     def _parse_flags(self):
         self.qr = (self.flags & 1 << 15) >> 15
-        self.opcode = (self.flags & 0x7800) >> 12
+        self.opcode = (self.flags & 0x7800) >> 11
         self.aa = (self.flags & 1 << 10) >> 10
         self.tc = (self.flags & 1 << 9) >> 9
         self.rd = (self.flags & 1 << 8) >> 8
@@ -36,65 +50,214 @@ class DNSMessageParser():
         self.z = (self.flags & 0x70) >> 4
         self.rcode = self.flags & 0xF
 
-    # return domain name if fist byte indicates offset
-    # then domain name is return from that offset
+    def _section_count(self, section):
+        return (self.count_questions, self.count_answers,
+                self.count_authorities, self.count_additional)[section]
+
+    # start index of section, earlier sections are skipped without decoding
+    def _section_offset(self, section):
+        if self._offsets[section] is None:
+            index = self._section_offset(section - 1)
+            for _ in range(self._section_count(section - 1)):
+                index = self._skip_name(index)
+                if section - 1 == 0:
+                    index += 4
+                else:
+                    index += 10 + unpack_from('!H', self.view, index + 8)[0]
+            if index > len(self.view):
+                raise DNSParseError('section runs past end of message')
+            self._offsets[section] = index
+        return self._offsets[section]
+
+    def _parse_section(self, section):
+        if self._sections[section] is None:
+            self.index = self._section_offset(section)
+            parse = self.parse_question if section == 0 else self.parse_result_set
+            self._sections[section] = [parse()
+                                       for _ in range(self._section_count(section))]
+            self._offsets[section + 1] = self.index
+        return self._sections[section]
+
+    @property
+    def questions(self):
+        return self._parse_section(0)
+
+    @property
+    def answers(self):
+        return self._parse_section(1)
+
+    @property
+    def authorities(self):
+        return self._parse_section(2)
+
+    @property
+    def additions(self):
+        return self._parse_section(3)
+
+    # (ttl index, ttl, type) of every result set, names and data are skipped
+    # (OPT record ttl field holds EDNS0 flags, not ttl)
+    def record_ttls(self):
+        if self._sections[1] is not None and self._sections[2] is not None \
+                and self._sections[3] is not None:
+            return [(result_set.ttl_index, result_set.time_to_leave, result_set.rtype)
+                    for result_set in self.answers + self.authorities + self.additions]
+        ttls = []
+        index = self._section_offset(1)
+        for _ in range(self.count_answers + self.count_authorities + self.count_additional):
+            index = self._skip_name(index)
+            result_type, _, time_to_leave, rdata_length = unpack_from(
+                '!HHIH', self.view, index)
+            ttls.append((index + 4, time_to_leave, result_type))
+            index += 10 + rdata_length
+        return ttls
+
+    # (section, end index) of every result set, sections numbered
+    # 1 answer, 2 authority, 3 additional, names and data are skipped
+    def record_ends(self):
+        ends = []
+        index = self._section_offset(1)
+        for section in (1, 2, 3):
+            for _ in range(self._section_count(section)):
+                index = self._skip_name(index)
+                index += 10 + unpack_from('!H', self.view, index + 8)[0]
+                if index > len(self.view):
+                    raise DNSParseError('result set runs past end of message')
+                ends.append((section, index))
+        return ends
+
+    # index where question section ends (first result set starts)
+    def question_section_end(self):
+        return self._section_offset(1)
+
+    # (start, end) index of EDNS0 OPT record in additional section, None if absent
+    def opt_span(self):
+        if self.count_additional == 0:
+            return None
+        index = self._section_offset(3)
+        for _ in range(self.count_additional):
+            start = index
+            index = self._skip_name(index)
+            result_type, _, _, rdata_length = unpack_from('!HHIH', self.view, index)
+            index += 10 + rdata_length
+            if result_type == Types.OPT:
+                return start, index
+        return None
+
+    # EDNS0 values of message, None if sender does not use EDNS0
+    @property
+    def edns(self):
+        if self._edns is False:
+            span = self.opt_span()
+            self._edns = None
+            if span is not None:
+                _, udp_payload_size, flags, _ = unpack_from(
+                    '!HHIH', self.view, self._skip_name(span[0]))
+                self._edns = EdnsSet(max(udp_payload_size, MSG_SIZE), flags >> 24,
+                                     (flags >> 16) & 0xFF, (flags >> 15) & 1)
+        return self._edns
+
+    # largest udp response sender accepts
+    def udp_payload_size(self):
+        edns = self.edns
+        return edns.udp_payload_size if edns is not None else MSG_SIZE
+
+    def _skip_name(self, index):
+        try:
+            while True:
+                octet = self.view[index]
+                if octet == 0:
+                    return index + 1
+                if octet & 0xC0 == 0xC0:  # DNS Packet Compression
+                    return index + 2
+                if octet & 0xC0:
+                    raise DNSParseError('unsupported label type')
+                index += octet + 1
+        except IndexError:
+            raise DNSParseError('name runs past end of message')
+
+    # return (domain name, index after name)
+    # compression pointers are followed iteratively, every pointer has to go
+    # strictly before previous one so pointer loops can not happen
     def _parse_name(self, index):
-        name = ''
-        while True:
-            octet = unpack('!B', self.request[index:index + 1])[0]
-            if octet == 0:
-                return (name, index + 1)
-            if octet & 0xC0 != 0xC0:  # 11*
-                name += self.request[index + 1: index +
-                                     1 + octet].decode('utf-8') + '.'
+        view = self.view
+        labels = []
+        name_length = 0
+        end = None
+        limit = index
+        try:
+            while True:
+                octet = view[index]
+                if octet == 0:
+                    break
+                if octet & 0xC0 == 0xC0:  # DNS Packet Compression
+                    offset = (octet & 0x3F) << 8 | view[index + 1]
+                    if end is None:
+                        end = index + 2
+                    if offset >= limit:
+                        raise DNSParseError('compression pointer loop')
+                    limit = index = offset
+                    continue
+                if octet & 0xC0:
+                    raise DNSParseError('unsupported label type')
+                name_length += octet + 1
+                if name_length > MAX_NAME_LENGTH or index + 1 + octet > len(view):
+                    raise DNSParseError('bad domain name')
+                labels.append(view[index + 1:index + 1 + octet].tobytes())
                 index += octet + 1
-            else:  # DNS Packet Compression
-                offset = unpack('!H', self.request[index:index + 2])[0]
-                offset &= 0x3FFF  # make first two bits  zero
-                return (name + self._parse_name(offset)[0], index + 2)
-        return (name, index)
+        except IndexError:
+            raise DNSParseError('name runs past end of message')
+        if end is None:
+            end = index + 1
+        if not labels:
+            return ('', end)
+        return (b'.'.join(labels).decode('utf-8') + '.', end)
 
     def parse_question(self):
         domain_name, self.index = self._parse_name(self.index)
-        qtype, qclass = unpack(
-            '!HH', self.request[self.index:self.index+4])
+        qtype, qclass = unpack_from('!HH', self.view, self.index)
         self.index += 4
         return QuestionSet(domain_name, qtype, qclass)
 
     def parse_result_set(self):
         name, self.index = self._parse_name(self.index)
-        result_type, result_class, time_to_leave, rdata_length = unpack(
-            '!HHIH', self.request[self.index:self.index+10])
+        result_type, result_class, time_to_leave, rdata_length = unpack_from(
+            '!HHIH', self.view, self.index)
+        ttl_index = self.index + 4
         self.index += 10
+        if self.index + rdata_length > len(self.view):
+            raise DNSParseError('record data runs past end of message')
         data = self._parse_rdata(
             result_type, result_class, rdata_length)
         self.index += rdata_length
-        return ResultSet(name, result_type, result_class, time_to_leave, data)
+        return ResultSet(name, result_type, result_class, time_to_leave, data, ttl_index)
 
     def _parse_rdata(self, answer_type, answer_class, rdata_length):
         if answer_type == Types.A:
-            ip_bytes = unpack('!BBBB', self.request[self.index:self.index+4])
-            ipv4 = f'{ip_bytes[0]}.{ip_bytes[1]}.{ip_bytes[2]}.{ip_bytes[3]}'
-            return ipv4
+            return '%d.%d.%d.%d' % tuple(self.view[self.index:self.index+4])
         if answer_type == Types.CNAME or answer_type == Types.NS:
             name, _ = self._parse_name(self.index)
             return name
         if answer_type == Types.MX:
-            pref = unpack('!H', self.request[self.index:self.index+2])
-            mail = self._parse_name(self.index+2)
-            return (pref, *mail)
+            pref = unpack_from('!H', self.view, self.index)[0]
+            mail, _ = self._parse_name(self.index+2)
+            return (pref, mail)
         if answer_type == Types.SOA:
             name_server, new_index = self._parse_name(self.index)
             host, new_index = self._parse_name(new_index)
-            rest_info = unpack(
-                '!IIIII', self.request[new_index:new_index+20])
+            rest_info = unpack_from('!IIIII', self.view, new_index)
             return (name_server, host, *rest_info)  # change this
         if answer_type == Types.TXT:
-            text = self.request[self.index+1:self.index +
-                                rdata_length-1].decode('utf-8')
-            return text
+            # one or more length prefixed strings
+            texts = []
+            index = self.index
+            end = self.index + rdata_length
+            while index < end:
+                length = self.view[index]
+                texts.append(self.view[index+1:index+1+length].tobytes())
+                index += length + 1
+            return b''.join(texts).decode('utf-8')
         if answer_type == Types.AAAA:
-            return IPv6Address(self.request[self.index:self.index+rdata_length]).compressed
+            return IPv6Address(self.view[self.index:self.index+rdata_length].tobytes()).compressed
         # unsupported
         return None
 
@@ -0,0 +1,102 @@
+import json
+import os
+import random
+import threading
+import time
+import traceback
+from collections import deque
+from constants import (QUERY_LOG_BACKUPS, QUERY_LOG_BUFFER, QUERY_LOG_FLUSH_INTERVAL,
+                       QUERY_LOG_MAX_BYTES, Types)
+
+QUERY_LOG_FIELDS = ('time', 'client', 'name', 'type', 'rcode', 'source', 'latency_ms',
+                    'upstream')
+
+
+# structured query log, one json object per line
+# serving loop only appends tuple to bounded buffer, when it is full entries
+# are dropped and counted instead of waiting; background thread formats
+# and writes them in batches every flush interval and rotates file when it
+# grows over max_bytes (path.1 ... path.backups)
+# sample_rate below 1 logs that fraction of queries
+class QueryLog():
+
+    def __init__(self, path, sample_rate=1.0, buffer_size=QUERY_LOG_BUFFER,
+                 flush_interval=QUERY_LOG_FLUSH_INTERVAL, max_bytes=QUERY_LOG_MAX_BYTES,
+                 backups=QUERY_LOG_BACKUPS):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        # deque append and popleft are atomic, no lock between loop and writer
+        self.buffer = deque()
+        self.dropped = 0
+        self.written = 0
+        self.file = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def log(self, client, name, qtype_code, rcode, source, latency, upstream=0):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        if len(self.buffer) >= self.buffer_size:
+            self.dropped += 1
+            return
+        self.buffer.append((time.time(), client, name, qtype_code, rcode, source, latency,
+                            upstream))
+
+    @staticmethod
+    def _format(entry):
+        logged_at, client, name, qtype_code, rcode, source, latency, upstream = entry
+        return json.dumps(dict(zip(QUERY_LOG_FIELDS, (
+            round(logged_at, 3), client, name, Types.reversed_types.get(qtype_code, qtype_code),
+            rcode, source, round(latency * 1000, 3), upstream)))) + '\n'
+
+    # write everything buffered so far in one write
+    def flush(self):
+        lines = []
+        for _ in range(len(self.buffer)):
+            lines.append(self._format(self.buffer.popleft()))
+        if not lines:
+            return
+        if self.file is None:
+            self.file = open(self.path, 'a')
+        self.file.write(''.join(lines))
+        self.file.flush()
+        self.written += len(lines)
+        if self.max_bytes and self.file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self.file.close()
+        self.file = None
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{index}'):
+                os.replace(f'{self.path}.{index}', f'{self.path}.{index + 1}')
+        if self.backups:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def _run(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                traceback.print_exc()
+
+    # stop writer thread and write what is left
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
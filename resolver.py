@@ -0,0 +1,306 @@
+import asyncio
+import contextvars
+from parser import DNSMessageParser
+from builder import DNSMessageBuilder, set_request_id, spell_question, strip_opt
+from delegation import DelegationCache, name_suffixes
+from constants import (MAX_REFERRALS, MAX_RESOLUTION_DEPTH, ROOT_SERVER_IPS,
+                       UPSTREAM_PORT, UPSTREAM_RACE, ResponseCode, Types,
+                       random_id)
+from metrics import COUNT_BUCKETS, Metrics
+from upstream import UpstreamPool
+
+# [upstream queries] of client query being resolved, set by server so
+# resolutions started for it (name server lookups included) are counted
+upstream_queries = contextvars.ContextVar('upstream_queries', default=None)
+
+
+# iterative resolver: walks from closest known zone cut down to
+# authoritative servers, answers go to cache, referrals to delegation cache
+# names under zone of forward rule are sent to its resolvers instead
+class Resolver():
+
+    def __init__(self, cache, delegations=None, root_servers=ROOT_SERVER_IPS,
+                 upstream_port=UPSTREAM_PORT, upstream=None, race=UPSTREAM_RACE,
+                 metrics=None, forward_zones=None, forward_only=True):
+        self.cache = cache
+        self.delegations = delegations if delegations is not None else DelegationCache()
+        self.root_servers = root_servers
+        self.upstream_port = upstream_port
+        # pooled sockets and rtt of every name server asked
+        self.upstream = upstream if upstream is not None else UpstreamPool()
+        # how many name servers are asked at once
+        self.race = max(1, race)
+        # (name, qtype, qclass): future of resolution running for it,
+        # later askers wait for it instead of starting their own
+        self.in_flight = {}
+        # in-flight key: in-flight key its resolution is waiting for
+        self.waits_for = {}
+        self.metrics = metrics if metrics is not None else Metrics()
+        # lower cased zone ('' for all names): upstream resolver ips,
+        # rule of longest matching zone wins
+        self.forward_zones = {}
+        for zone, server_ips in (forward_zones or {}).items():
+            zone = zone.lower().strip('.')
+            self.forward_zones[zone + '.' if zone else ''] = list(server_ips)
+        # if forwarders fail, name is not iterated from root servers
+        self.forward_only = forward_only
+
+    # reply that can be used for resolution: no server error
+    # (truncated reply is usable, it is repeated over tcp)
+    @staticmethod
+    def _accept_response(server_ip, server_response):
+        try:
+            parsed_response = DNSMessageParser(server_response, lazy=True)
+        except Exception:
+            return None
+        if parsed_response.rcode not in (ResponseCode.NO_ERROR, ResponseCode.NAME_ERROR):
+            return None
+        return server_response, parsed_response
+
+    # send query to name servers at once without blocking event loop,
+    # returns first usable (response, parsed response) or (None, None)
+    # if answer does not fit in udp it is asked from same server over tcp,
+    # OPT record of server is removed, server speaks EDNS0 only to us
+    async def _ask_servers(self, server_ips, message, message_id):
+        server_ip, accepted = await self.upstream.race(
+            server_ips, self.upstream_port, message, message_id, self._accept_response)
+        if accepted is None:
+            return None, None
+        server_response, parsed_response = accepted
+        if parsed_response.tc == 1:
+            self.metrics.incr('dns_upstream_tcp_queries_total')
+            server_response = await self.upstream.query_tcp(
+                server_ip, self.upstream_port, message, message_id)
+            accepted = self._accept_response(server_ip, server_response) \
+                if server_response else None
+            if accepted is None or accepted[1].tc == 1:
+                return None, None
+            server_response, parsed_response = accepted
+        if parsed_response.opt_span() is not None:
+            server_response = strip_opt(server_response, parsed_response)
+            parsed_response = DNSMessageParser(server_response, lazy=True)
+        return server_response, parsed_response
+
+    # build recursion desired request for root or name servers,
+    # with EDNS0 so servers can send answers bigger than 512 bytes
+    @staticmethod
+    def _build_rd_query(name, qtype_code, request_id):
+        builder = DNSMessageBuilder(request_id)
+        builder.build_flags()
+        builder.build_head(1, 0, 0, 1)
+        builder.build_query(name, qtype_code, 1)
+        builder.build_opt()
+        return builder.message
+
+    # NXDOMAIN, or authoritative answer without records (NODATA)
+    @staticmethod
+    def _is_negative(parsed_response):
+        if parsed_response.rcode == ResponseCode.NAME_ERROR:
+            return True
+        return parsed_response.rcode == ResponseCode.NO_ERROR and parsed_response.aa == 1 and \
+            not any(auth.rtype == Types.NS for auth in parsed_response.authorities)
+
+    # save zone cut and glue from referral response
+    # returns (referred zone, ns names) or None if response is not a referral below zone
+    def _save_referral(self, parsed_response, name, zone):
+        cut = None
+        ns_names = []
+        time_to_leave = None
+        for auth in parsed_response.authorities:
+            if auth.rtype != Types.NS:
+                continue
+            owner = auth.name.lower()
+            # referral must move closer to name, otherwise server is lame
+            if owner == zone or owner not in name_suffixes(name) or \
+                    (zone and not owner.endswith('.' + zone)):
+                continue
+            if cut is None:
+                cut = owner
+            if owner == cut:
+                ns_names.append(auth.rdata)
+                time_to_leave = auth.time_to_leave if time_to_leave is None \
+                    else min(time_to_leave, auth.time_to_leave)
+        if cut is None:
+            return None
+        self.delegations.add_delegation(cut, ns_names, time_to_leave)
+        # only glue inside referred zone is trusted (bailiwick): any server
+        # could otherwise plant addresses for name servers of other zones,
+        # names outside it are resolved in _zone_server_ips
+        lower_ns_names = {ns_name.lower() for ns_name in ns_names
+                          if ns_name.lower() == cut or ns_name.lower().endswith('.' + cut)}
+        glue = {}
+        for addit in parsed_response.additions:
+            if addit.rtype == Types.A and addit.name.lower() in lower_ns_names:
+                ips, ttl = glue.get(addit.name.lower(), ([], addit.time_to_leave))
+                ips.append(addit.rdata)
+                glue[addit.name.lower()] = (ips, min(ttl, addit.time_to_leave))
+        for ns_name, (ips, ttl) in glue.items():
+            self.delegations.add_addresses(ns_name, ips, ttl)
+        return cut, ns_names
+
+    # addresses of zone name servers, names without glue are resolved
+    # (through caches) until some address is found
+    async def _zone_server_ips(self, ns_names, chain):
+        server_ips = []
+        unresolved = []
+        for ns_name in ns_names:
+            ips = self.delegations.get_addresses(ns_name)
+            if ips:
+                server_ips.extend(ips)
+            else:
+                unresolved.append(ns_name)
+        if server_ips or len(chain) >= MAX_RESOLUTION_DEPTH:
+            return server_ips
+        for ns_name in unresolved:
+            if (ns_name.lower(), Types.A, 1) in chain:
+                # name server address depends on itself
+                continue
+            new_id = random_id()  # new random 16 bit id for query
+            res_message = await self.resolve(ns_name, Types.A, new_id, chain)
+            if not res_message:
+                continue
+            parsed = DNSMessageParser(res_message, lazy=True)
+            answers = [answer for answer in parsed.answers if answer.rtype == Types.A]
+            if answers:
+                ips = [answer.rdata for answer in answers]
+                self.delegations.add_addresses(
+                    ns_name, ips, min(answer.time_to_leave for answer in answers))
+                return ips
+        return server_ips
+
+    # deepest cached zone cut with reachable name servers, root otherwise
+    async def _closest_servers(self, name, chain):
+        for zone, ns_names in self.delegations.enclosing(name):
+            server_ips = await self._zone_server_ips(ns_names, chain)
+            if server_ips:
+                return zone, server_ips
+        return '', self.root_servers
+
+    # resolvers of forward rule with longest zone matching name, None if
+    # name is resolved iteratively
+    def _forwarders(self, name):
+        if not self.forward_zones:
+            return None
+        for suffix in name_suffixes(name):
+            server_ips = self.forward_zones.get(suffix)
+            if server_ips:
+                return server_ips
+        return None
+
+    # ask resolvers recursion desired query, faster and healthier ones more
+    # often, first usable reply is the answer
+    async def _forward(self, name, qtype_code, server_ips, message, query_id, asked):
+        candidates = self.upstream.stats.balanced(server_ips)
+        while candidates:
+            batch, candidates = candidates[:self.race], candidates[self.race:]
+            asked.update((None, server_ip) for server_ip in batch)
+            self.metrics.incr('dns_upstream_forwarded_total')
+            server_response, parsed_server_response = await self._ask_servers(
+                batch, message, query_id)
+            if server_response is None:
+                continue
+            self.cache.put(name, qtype_code, server_response, parsed_server_response)
+            return server_response
+        return None
+
+    # resolution of key would wait for waiter itself
+    def _would_deadlock(self, waiter, key):
+        while key is not None:
+            if key == waiter:
+                return True
+            key = self.waits_for.get(key)
+        return False
+
+    # resolve domain name and type
+    # first,  the function lookups in local cashe
+    # then joins identical resolution already in flight, if any
+    # chain holds (name, qtype, qclass) resolutions this one is part of,
+    # innermost last, so name server lookups can not loop
+    # refresh skips cache, e.g. to prefetch entry before it expires
+    async def resolve(self, name, qtype_code, request_id, chain=(), qclass=1, refresh=False):
+        if not refresh:
+            cache_res = self.cache.get(name, qtype_code, request_id)
+            if cache_res is not None:
+                return cache_res
+        key = (name.lower(), qtype_code, qclass)
+        waiter = chain[-1] if chain else None
+        pending = self.in_flight.get(key)
+        if pending is not None and not self._would_deadlock(waiter, key):
+            if waiter is not None:
+                self.waits_for[waiter] = key
+            try:
+                response = await asyncio.shield(pending)
+            finally:
+                self.waits_for.pop(waiter, None)
+            if response is None:
+                return None
+            # copy of first asker's response with own request id and
+            # question spelled as this asker wrote it
+            return spell_question(set_request_id(response, request_id), name)
+
+        future = asyncio.get_running_loop().create_future()
+        if pending is None:
+            self.in_flight[key] = future
+        response = None
+        try:
+            response = await self._resolve(
+                name, qtype_code, request_id, chain + (key,))
+            return response
+        finally:
+            future.set_result(response)
+            if self.in_flight.get(key) is future:
+                del self.in_flight[key]
+
+    # if not found starts from closest known zone cut (root servers at worst)
+    # if return response contains proper answer response is returned
+    # if it is referral, follows to name servers of referred zone
+    # upstream queries get own random id, reply gets request id back
+    async def _resolve(self, name, qtype_code, request_id, chain):
+        query_id = random_id()
+        message = self._build_rd_query(name, qtype_code, query_id)
+
+        asked = set()  # (zone, server ip) already tried by this query
+        try:
+            forwarders = self._forwarders(name)
+            if forwarders is not None:
+                server_response = await self._forward(
+                    name, qtype_code, forwarders, message, query_id, asked)
+                if server_response is not None:
+                    return set_request_id(server_response, request_id)
+                if self.forward_only:
+                    return None
+            zone, server_ips = await self._closest_servers(name, chain)
+            for _ in range(MAX_REFERRALS):
+                referral = None
+                # fastest servers first, failing ones last
+                candidates = [server_ip for server_ip in self.upstream.stats.order(server_ips)
+                              if (zone, server_ip) not in asked]
+                while candidates:
+                    batch, candidates = candidates[:self.race], candidates[self.race:]
+                    asked.update((zone, server_ip) for server_ip in batch)
+                    server_response, parsed_server_response = await self._ask_servers(
+                        batch, message, query_id)
+                    # if receive something usable
+                    if server_response is None:
+                        continue
+                    if parsed_server_response.count_answers > 0 or \
+                            self._is_negative(parsed_server_response):
+                        # answer, or name does not exist / has no such records,
+                        # asking other servers would not change that
+                        self.cache.put(name, qtype_code, server_response,
+                                       parsed_server_response)
+                        return set_request_id(server_response, request_id)
+                    referral = self._save_referral(parsed_server_response, name, zone)
+                    if referral is not None:
+                        break
+                if referral is None:
+                    return None
+                zone, ns_names = referral
+                server_ips = await self._zone_server_ips(ns_names, chain)
+            return None
+        finally:
+            self.metrics.observe('dns_upstream_queries_per_resolution', len(asked),
+                                 COUNT_BUCKETS)
+            counter = upstream_queries.get()
+            if counter is not None:
+                counter[0] += len(asked)
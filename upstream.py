@@ -0,0 +1,343 @@
+import asyncio
+import random
+import socket
+from struct import pack, unpack
+from time import monotonic
+from constants import (UPSTREAM_BACKOFF, UPSTREAM_MAX_BACKOFF, UPSTREAM_MIN_TIMEOUT,
+                       UPSTREAM_POOL_SIZE, UPSTREAM_SOCKET_MAX_USES, UPSTREAM_TCP_IDLE,
+                       UPSTREAM_TCP_TIMEOUT, UPSTREAM_TIMEOUT)
+from metrics import Histogram
+
+# smoothed rtt assumed for servers never asked before (seconds)
+INITIAL_RTT = 0.05
+RTT_WEIGHT = 0.3
+# smoothed error rate: weight of newest reply/failure and how much a fully
+# failing server is slower than its rtt when servers are ranked
+ERROR_WEIGHT = 0.1
+ERROR_PENALTY = 10
+
+
+# what is known about one upstream server
+class ServerState():
+    __slots__ = ('srtt', 'fails_in_row', 'backoff_until', 'replies', 'failures',
+                 'error_rate')
+
+    def __init__(self, srtt):
+        self.srtt = srtt
+        self.fails_in_row = 0
+        self.backoff_until = 0
+        self.replies = 0
+        self.failures = 0
+        # smoothed share of queries that failed
+        self.error_rate = 0
+
+
+# smoothed rtt, error rate and failure backoff of every upstream server
+class ServerStats():
+
+    def __init__(self):
+        self.servers = {}  # ip: ServerState
+        # rtt of every reply from any server
+        self.rtts = Histogram()
+
+    def _get(self, server_ip):
+        state = self.servers.get(server_ip)
+        if state is None:
+            # small jitter so unknown servers are explored in random order
+            state = self.servers[server_ip] = ServerState(
+                INITIAL_RTT * (1 + random.random() / 10))
+        return state
+
+    # expected cost of asking server: rtt made worse by its error rate
+    def _score(self, server_ip):
+        state = self._get(server_ip)
+        return state.srtt * (1 + ERROR_PENALTY * state.error_rate)
+
+    def success(self, server_ip, rtt):
+        state = self._get(server_ip)
+        state.srtt += (rtt - state.srtt) * RTT_WEIGHT
+        state.fails_in_row = 0
+        state.backoff_until = 0
+        state.replies += 1
+        state.error_rate -= state.error_rate * ERROR_WEIGHT
+        self.rtts.observe(rtt)
+
+    def failure(self, server_ip):
+        state = self._get(server_ip)
+        state.srtt = min(state.srtt * 2, UPSTREAM_TIMEOUT)
+        state.fails_in_row += 1
+        state.failures += 1
+        state.error_rate += (1 - state.error_rate) * ERROR_WEIGHT
+        state.backoff_until = monotonic() + min(
+            UPSTREAM_BACKOFF * 2 ** (state.fails_in_row - 1), UPSTREAM_MAX_BACKOFF)
+
+    # fastest (and least failing) first, servers in backoff at the end
+    def order(self, server_ips):
+        now = monotonic()
+        return sorted(server_ips, key=lambda server_ip: (
+            self._get(server_ip).backoff_until > now, self._score(server_ip)))
+
+    # random order weighted by 1 / score, load is spread over servers in
+    # proportion to their speed and health, servers in backoff at the end
+    def balanced(self, server_ips):
+        now = monotonic()
+        healthy = [server_ip for server_ip in server_ips
+                   if self._get(server_ip).backoff_until <= now]
+        weights = [1 / self._score(server_ip) for server_ip in healthy]
+        ordered = []
+        while healthy:
+            index = random.choices(range(len(healthy)), weights)[0]
+            ordered.append(healthy.pop(index))
+            weights.pop(index)
+        return ordered + [server_ip for server_ip in self.order(server_ips)
+                          if server_ip not in ordered]
+
+    # wait a few smoothed rtts, but not longer than fixed timeout
+    def timeout(self, server_ip):
+        state = self.servers.get(server_ip)
+        if state is None or state.fails_in_row > 0:
+            return UPSTREAM_TIMEOUT
+        if state.replies == 0:
+            # never replied, rtt is only assumed (INITIAL_RTT): distant
+            # servers would time out on first query and be backed off
+            return UPSTREAM_TIMEOUT
+        return min(max(state.srtt * 4, UPSTREAM_MIN_TIMEOUT), UPSTREAM_TIMEOUT)
+
+    def rtt(self, server_ip):
+        state = self.servers.get(server_ip)
+        return state.srtt if state else None
+
+
+# one unconnected udp socket on random source port shared by many queries,
+# replies are matched to waiting queries by (server address, message id)
+class UpstreamSocket(asyncio.DatagramProtocol):
+
+    def __init__(self):
+        self.transport = None
+        self.pending = {}  # (ip, port, message id): future
+        self.uses = 0
+        self.retired = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        if len(data) < 12:
+            return
+        future = self.pending.get((address[0], address[1], unpack('!H', data[:2])[0]))
+        if future is not None and not future.done():
+            future.set_result(data)
+
+    def error_received(self, exc):
+        # icmp errors can not be matched to query, they time out
+        pass
+
+    def connection_lost(self, exc):
+        for future in self.pending.values():
+            if not future.done():
+                future.cancel()
+
+    def close_if_idle(self):
+        if self.retired and not self.pending:
+            self.transport.close()
+
+
+# dns over tcp connection to one upstream server, queries are pipelined
+# and replies matched by message id, they may come in any order (RFC 7766)
+class UpstreamConnection():
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pending = {}  # message id: future
+        self.closed = False
+        self.last_used = monotonic()
+        self.read_task = asyncio.ensure_future(self._read_responses())
+
+    async def _read_responses(self):
+        try:
+            while True:
+                length = unpack('!H', await self.reader.readexactly(2))[0]
+                data = await self.reader.readexactly(length)
+                if len(data) < 12:
+                    continue
+                future = self.pending.get(unpack('!H', data[:2])[0])
+                if future is not None and not future.done():
+                    future.set_result(data)
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            self.close()
+
+    async def query(self, message, message_id, timeout):
+        if self.closed or message_id in self.pending:
+            return None
+        future = asyncio.get_running_loop().create_future()
+        self.pending[message_id] = future
+        try:
+            self.writer.write(pack('!H', len(message)) + message)
+            return await asyncio.wait_for(future, timeout)
+        except (asyncio.TimeoutError, OSError):
+            return None
+        finally:
+            self.pending.pop(message_id, None)
+            self.last_used = monotonic()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.close()
+        self.read_task.cancel()
+        for future in self.pending.values():
+            if not future.done():
+                future.set_result(None)
+
+
+def _random_port_socket():
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for _ in range(10):
+        try:
+            udp_socket.bind(('0.0.0.0', random.randint(1024, 65535)))
+            break
+        except OSError:
+            continue
+    else:
+        udp_socket.bind(('0.0.0.0', 0))
+    udp_socket.setblocking(False)
+    return udp_socket
+
+
+# reusable upstream sockets with per server rtt tracking,
+# sockets are replaced after some queries so source ports keep changing
+class UpstreamPool():
+
+    def __init__(self, size=UPSTREAM_POOL_SIZE, stats=None):
+        self.size = size
+        self.stats = stats if stats is not None else ServerStats()
+        self.sockets = []
+        # (ip, port): open tcp connection / future of connection being opened
+        self.connections = {}
+        self.connecting = {}
+
+    async def _get_socket(self, key):
+        if len(self.sockets) >= self.size:
+            free = [upstream for upstream in self.sockets if key not in upstream.pending]
+            if free:
+                return random.choice(free)
+        loop = asyncio.get_running_loop()
+        _, upstream = await loop.create_datagram_endpoint(
+            UpstreamSocket, sock=_random_port_socket())
+        if len(self.sockets) < self.size:
+            self.sockets.append(upstream)
+        else:
+            # same server and id already pending on every pooled socket,
+            # use one off socket
+            upstream.retired = True
+        return upstream
+
+    def _release(self, upstream, key):
+        upstream.pending.pop(key, None)
+        upstream.uses += 1
+        if upstream.uses >= UPSTREAM_SOCKET_MAX_USES and not upstream.retired:
+            upstream.retired = True
+            self.sockets.remove(upstream)
+        upstream.close_if_idle()
+
+    # send message to server, returns reply bytes or None on timeout
+    async def query(self, server_ip, port, message, message_id):
+        key = (server_ip, port, message_id)
+        try:
+            upstream = await self._get_socket(key)
+        except OSError:
+            return None
+        future = asyncio.get_running_loop().create_future()
+        upstream.pending[key] = future
+        sent_at = monotonic()
+        try:
+            upstream.transport.sendto(message, (server_ip, port))
+            response = await asyncio.wait_for(future, self.stats.timeout(server_ip))
+        except (asyncio.TimeoutError, OSError):
+            self.stats.failure(server_ip)
+            return None
+        finally:
+            self._release(upstream, key)
+        self.stats.success(server_ip, monotonic() - sent_at)
+        return response
+
+    # send message to all servers at once and return (server ip, accepted)
+    # where accepted = accept(server_ip, reply) is not None for first reply,
+    # (None, None) if no server gave acceptable reply
+    async def race(self, server_ips, port, message, message_id, accept):
+        async def ask(server_ip):
+            return server_ip, await self.query(server_ip, port, message, message_id)
+
+        tasks = [asyncio.ensure_future(ask(server_ip)) for server_ip in server_ips]
+        try:
+            for next_reply in asyncio.as_completed(tasks):
+                server_ip, response = await next_reply
+                if response is None:
+                    continue
+                accepted = accept(server_ip, response)
+                if accepted is not None:
+                    return server_ip, accepted
+        finally:
+            for task in tasks:
+                task.cancel()
+        return None, None
+
+    async def _get_connection(self, server_ip, port):
+        key = (server_ip, port)
+        connection = self.connections.get(key)
+        if connection is not None and not connection.closed:
+            return connection
+        opening = self.connecting.get(key)
+        if opening is not None:
+            return await asyncio.shield(opening)
+        loop = asyncio.get_running_loop()
+        opening = self.connecting[key] = loop.create_future()
+        connection = None
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(server_ip, port), UPSTREAM_TCP_TIMEOUT)
+            connection = self.connections[key] = UpstreamConnection(reader, writer)
+            loop.call_later(UPSTREAM_TCP_IDLE, self._close_idle, key, connection)
+        except (asyncio.TimeoutError, OSError):
+            self.stats.failure(server_ip)
+        finally:
+            opening.set_result(connection)
+            del self.connecting[key]
+        return connection
+
+    def _close_idle(self, key, connection):
+        if connection.closed:
+            return
+        idle = monotonic() - connection.last_used
+        if connection.pending or idle < UPSTREAM_TCP_IDLE:
+            asyncio.get_running_loop().call_later(
+                max(UPSTREAM_TCP_IDLE - idle, 1), self._close_idle, key, connection)
+            return
+        connection.close()
+        if self.connections.get(key) is connection:
+            del self.connections[key]
+
+    # send message over pooled tcp connection, used when udp reply is truncated
+    # returns reply bytes or None
+    async def query_tcp(self, server_ip, port, message, message_id):
+        for _ in range(2):
+            connection = await self._get_connection(server_ip, port)
+            if connection is None:
+                return None
+            response = await connection.query(message, message_id, UPSTREAM_TCP_TIMEOUT)
+            if response is not None or not connection.closed:
+                return response
+            # server closed idle connection before reply, retry on new one
+        return None
+
+    def close(self):
+        for upstream in self.sockets:
+            upstream.transport.close()
+        self.sockets = []
+        for connection in self.connections.values():
+            connection.close()
+        self.connections = {}
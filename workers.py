@@ -0,0 +1,83 @@
+import gc
+import os
+import signal
+import sys
+import time
+import traceback
+
+# worker that dies sooner than this after start is considered crash looping
+# and is restarted with a delay
+MIN_WORKER_UPTIME = 1
+RESTART_DELAY = 1
+
+
+def _spawn(index, start_worker):
+    pid = os.fork()
+    if pid != 0:
+        return pid
+    # child: default signal handling, run server until it dies
+    # SIGHUP forwarded by supervisor is ignored until worker installs
+    # its reload handler, default action would kill worker while it starts
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    exit_code = 0
+    try:
+        start_worker(index)
+    except BaseException:
+        traceback.print_exc()
+        exit_code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(exit_code)
+
+
+# fork count processes running start_worker(index) and supervise them
+# data loaded before calling this (zones) is shared copy-on-write
+def run_workers(count, start_worker):
+    # move already loaded objects out of gc generations so collections in
+    # workers do not touch (and copy) their pages
+    gc.freeze()
+    workers = {}  # pid: (index, start time)
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    # workers reload their zones themselves
+    def forward(signum, frame):
+        for pid in list(workers):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, forward)
+
+    for index in range(count):
+        workers[_spawn(index, start_worker)] = (index, time.monotonic())
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        index, started = workers.pop(pid, (None, None))
+        if index is None or stopping:
+            continue
+        print(f'worker {index} (pid {pid}) exited with status {status}, restarting')
+        if time.monotonic() - started < MIN_WORKER_UPTIME:
+            time.sleep(RESTART_DELAY)
+        if not stopping:
+            workers[_spawn(index, start_worker)] = (index, time.monotonic())
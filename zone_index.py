@@ -0,0 +1,502 @@
+from struct import Struct, pack, pack_into
+from zlib import crc32
+from builder import OPT_RECORD_SIZE, DNSMessageBuilder
+from delegation import name_suffixes
+from constants import MAX_CNAME_CHAIN, MSG_SIZE, ResponseCode, Types
+
+# flags of zone responses: response, authoritative (not for referrals)
+AUTHORITATIVE_FLAGS = 1 << 15 | 1 << 10 | 1 << 8 | 1 << 7
+REFERRAL_FLAGS = 1 << 15 | 1 << 8 | 1 << 7
+NO_RECORDS = (b'', 0)
+
+
+# returns (record datas, ttl) of name for query type
+# or ([], 0) if name has no such records, ttl is the one of record set
+# (easyzone keeps it in dnspython rdataset), else default_ttl of zone
+def _get_records(name_records, qtype_str, default_ttl=None):
+    try:
+        records = name_records.records(qtype_str)
+        items = records.get_items()
+    except Exception:
+        return [], 0
+    rdataset = getattr(records, '_rdataset', None)
+    ttl = rdataset.ttl if rdataset is not None else getattr(records, 'ttl', None)
+    if ttl is None:
+        ttl = default_ttl
+    if ttl is None:
+        raise ValueError(f'no ttl for {qtype_str} records of {name_records.name}')
+    return items, ttl
+
+
+def zone_apex(zone):
+    return zone.domain if zone.domain.endswith('.') else zone.domain + '.'
+
+
+# fields of SOA record of zone or None
+def _soa_fields(zone):
+    names = zone.get_names()
+    soa_datas, _ = _get_records(names[zone_apex(zone)], 'SOA', 0) \
+        if zone_apex(zone) in names else ([], 0)
+    if not soa_datas:
+        return None
+    return soa_datas[0].split() if isinstance(soa_datas[0], str) else soa_datas[0]
+
+
+# SOA serial of zone, None if zone has no SOA
+def zone_serial(zone):
+    soa = _soa_fields(zone)
+    return int(soa[2]) if soa is not None else None
+
+
+# ttl of records that have none of their own: zone $TTL when loader keeps it,
+# else SOA minimum (its meaning before RFC 2308), None if zone has no SOA
+def zone_default_ttl(zone):
+    ttl = getattr(zone, 'ttl', None)
+    if ttl is not None:
+        return ttl
+    soa = _soa_fields(zone)
+    return int(soa[6]) if soa is not None else None
+
+
+# (uncompressed result set records, count) that can be copied into any response,
+# owner None is written as pointer to question name
+def _records(owner, rtype, ttl, datas):
+    builder = DNSMessageBuilder(0, compress=False)
+    for data in datas:
+        builder.build_answer(owner, rtype, 1, ttl, data)
+    return builder.message, len(datas)
+
+
+def _join(*records):
+    return b''.join(data for data, _ in records), sum(count for _, count in records)
+
+
+# encoded question for name as client wrote it
+def _question(name, qtype_code):
+    encoded = bytearray()
+    for label in name.split('.'):
+        if label:
+            label = label.encode('utf-8')
+            encoded += pack('!B', len(label)) + label
+    encoded += b'\x00' + pack('!HH', qtype_code, 1)
+    return encoded
+
+
+def _response(request_id, flags, question, answer=NO_RECORDS, authority=NO_RECORDS,
+              additional=NO_RECORDS):
+    response = bytearray(pack('!HHHHHH', request_id, flags, 1,
+                              answer[1], authority[1], additional[1]))
+    response += question
+    response += answer[0]
+    response += authority[0]
+    response += additional[0]
+    return response
+
+
+# compiled zone is one buffer (bytes, or part of mapped zone snapshot)
+# nothing is decoded when it is loaded, lookups probe its hash table:
+#   header: table slots, finished responses, SOA record count and length, flags
+#   SOA records for authority section of NXDOMAIN/NODATA
+#   open addressing table (power of two slots, at most half used) indexed by
+#   crc32 of key, slot: key offset (0 if slot is empty), key length, data length
+#   keys, each followed by its data
+# key is section, lower cased name, 0 byte and query type, sections:
+#   RESPONSE: finished response for owner name and query type
+#   NAME: every existing name, empty non-terminals included, no data
+#   DELEGATION: child zone cut, data is NS records and glue records
+#   WILDCARD: closest encloser of '*' name, type 0 tells wildcard exists,
+#             other types have rcode, answer, authority and additional records
+# offsets are counted from start of zone buffer
+ZONE_HEADER = Struct('!IIHIB')
+ZONE_ENTRY = Struct('!IHI')
+DELEGATION_HEADER = Struct('!HHI')
+WILDCARD_HEADER = Struct('!BHHHII')
+RESPONSE, NAME, DELEGATION, WILDCARD = b'r', b'n', b'd', b'w'
+HAS_DELEGATIONS, HAS_WILDCARDS = 1, 2
+
+
+def _key(section, key_name, qtype_code=0):
+    return section + key_name.encode('utf-8') + pack('!BH', 0, qtype_code)
+
+
+# zone buffer of (key: data) entries and SOA records of zone
+def encode_zone(entries, negative=NO_RECORDS):
+    keys = sorted(entries)
+    slots = 1
+    while slots < 2 * len(keys):
+        slots *= 2
+    flags = 0
+    if any(key[:1] == DELEGATION for key in keys):
+        flags |= HAS_DELEGATIONS
+    if any(key[:1] == WILDCARD for key in keys):
+        flags |= HAS_WILDCARDS
+    responses = sum(1 for key in keys if key[:1] == RESPONSE)
+    offset = ZONE_HEADER.size + len(negative[0]) + slots * ZONE_ENTRY.size
+    table = bytearray(slots * ZONE_ENTRY.size)
+    contents = bytearray()
+    for key in keys:
+        data = entries[key]
+        slot = crc32(key) & (slots - 1)
+        while table[slot * ZONE_ENTRY.size:(slot + 1) * ZONE_ENTRY.size] != \
+                bytes(ZONE_ENTRY.size):
+            slot = (slot + 1) & (slots - 1)
+        ZONE_ENTRY.pack_into(table, slot * ZONE_ENTRY.size, offset + len(contents), len(key),
+                             len(data))
+        contents += key
+        contents += data
+    return ZONE_HEADER.pack(slots, responses, negative[1], len(negative[0]), flags) + \
+        negative[0] + bytes(table) + bytes(contents)
+
+
+# compiled zone over its buffer, apex is lower cased zone name
+class ZoneData():
+    __slots__ = ('apex', 'buffer', 'offset', 'length', 'slots', 'responses', 'negative_count',
+                 'negative_length', 'flags')
+
+    def __init__(self, apex, buffer, offset=0, length=None):
+        self.apex = apex
+        self.buffer = buffer
+        self.offset = offset
+        self.length = length if length is not None else len(buffer) - offset
+        self.slots, self.responses, self.negative_count, self.negative_length, self.flags = \
+            ZONE_HEADER.unpack_from(buffer, offset)
+
+    # zone buffer as bytes, e.g. to write it to snapshot
+    def data(self):
+        return bytes(self.buffer[self.offset:self.offset + self.length])
+
+    # SOA records, they go to authority section of NXDOMAIN/NODATA
+    @property
+    def negative(self):
+        start = self.offset + ZONE_HEADER.size
+        return self.buffer[start:start + self.negative_length], self.negative_count
+
+    # data of key, None if zone has no such key
+    def _find(self, section, key_name, qtype_code=0):
+        key = _key(section, key_name, qtype_code)
+        buffer = self.buffer
+        offset = self.offset
+        table = offset + ZONE_HEADER.size + self.negative_length
+        mask = self.slots - 1
+        slot = crc32(key) & mask
+        while True:
+            key_offset, key_length, data_length = ZONE_ENTRY.unpack_from(
+                buffer, table + slot * ZONE_ENTRY.size)
+            if not key_offset:
+                return None
+            key_offset += offset
+            if key_length == len(key) and buffer[key_offset:key_offset + key_length] == key:
+                key_offset += key_length
+                return buffer[key_offset:key_offset + data_length]
+            slot = (slot + 1) & mask
+
+    # (NS records, glue records) of zone cut, None if name is no cut
+    def _delegation(self, key_name):
+        data = self._find(DELEGATION, key_name)
+        if data is None:
+            return None
+        ns_count, glue_count, ns_length = DELEGATION_HEADER.unpack_from(data, 0)
+        start = DELEGATION_HEADER.size
+        return ((data[start:start + ns_length], ns_count),
+                (data[start + ns_length:], glue_count))
+
+    # (rcode, answer records, authority records, additional records)
+    def _wildcard_answer(self, key_name, qtype_code):
+        data = self._find(WILDCARD, key_name, qtype_code)
+        if data is None:
+            return None
+        rcode, answer_count, authority_count, additional_count, answer_length, \
+            authority_length = WILDCARD_HEADER.unpack_from(data, 0)
+        authority_start = WILDCARD_HEADER.size + answer_length
+        additional_start = authority_start + authority_length
+        return (rcode, (data[WILDCARD_HEADER.size:authority_start], answer_count),
+                (data[authority_start:additional_start], authority_count),
+                (data[additional_start:], additional_count))
+
+    # response for name under zone (name is lower cased key_name)
+    def answer(self, name, key_name, qtype_code, request_id):
+        question = _question(name, qtype_code)
+        response = self._find(RESPONSE, key_name, qtype_code)
+        if response is not None:
+            response = bytearray(response)
+            pack_into('!H', response, 0, request_id)
+            # question (and owners pointing to it) spelled as client wrote it
+            response[12:12 + len(question)] = question
+            return response
+        suffixes = name_suffixes(key_name)
+        below_apex = suffixes[:suffixes.index(self.apex)] if self.apex in suffixes else []
+        if self.flags & HAS_DELEGATIONS:
+            # topmost cut above name: we are not authoritative below it
+            for suffix in reversed(below_apex):
+                delegation = self._delegation(suffix)
+                if delegation is not None:
+                    return _response(request_id, REFERRAL_FLAGS, question,
+                                     authority=delegation[0], additional=delegation[1])
+        if self._find(NAME, key_name) is not None:
+            # name exists, only without records of that type
+            return _response(request_id, AUTHORITATIVE_FLAGS, question,
+                             authority=self.negative)
+        # wildcard of closest existing ancestor (RFC 4592)
+        if self.flags & HAS_WILDCARDS:
+            for suffix in below_apex[1:] + [self.apex]:
+                if suffix == self.apex or self._find(NAME, suffix) is not None:
+                    if self._find(WILDCARD, suffix) is None:
+                        break
+                    answer = self._wildcard_answer(suffix, qtype_code)
+                    if answer is None:
+                        return _response(request_id, AUTHORITATIVE_FLAGS, question,
+                                         authority=self.negative)
+                    rcode, answer, authority, additional = answer
+                    if 12 + len(question) + len(answer[0]) + len(authority[0]) + \
+                            len(additional[0]) + OPT_RECORD_SIZE > MSG_SIZE:
+                        # additional records are optional, answer is not truncated for them
+                        additional = NO_RECORDS
+                    return _response(request_id, AUTHORITATIVE_FLAGS | rcode, question,
+                                     answer, authority, additional)
+        return _response(request_id, AUTHORITATIVE_FLAGS | ResponseCode.NAME_ERROR, question,
+                         authority=self.negative)
+
+
+# names at or below some zone cut (other than apex) and the cuts
+def _find_cuts(names, apex):
+    cuts = {name.lower() for name, name_records in names.items()
+            if name.lower() != apex and _get_records(name_records, 'NS', 0)[0]}
+    below = set()
+    for name in names:
+        if any(suffix in cuts for suffix in name_suffixes(name)):
+            below.add(name)
+    return cuts, below
+
+
+# A/AAAA result sets (owner, type, ttl, datas) of host names that live in zone
+def _addresses(names_by_key, host_names, default_ttl):
+    unique = {}
+    for host_name in host_names:
+        unique.setdefault(host_name.lower(), host_name)
+    result_sets = []
+    for key_name, host_name in unique.items():
+        name_records = names_by_key.get(key_name)
+        if name_records is None:
+            continue
+        for qtype_str, qtype_code in (('A', Types.A), ('AAAA', Types.AAAA)):
+            datas, ttl = _get_records(name_records, qtype_str, default_ttl)
+            if datas:
+                result_sets.append((host_name, qtype_code, ttl, datas))
+    return result_sets
+
+
+# additional section of answer: addresses of MX exchanges and name servers
+def _additional(names_by_key, answer, default_ttl):
+    host_names = []
+    for _, rtype, _, datas in answer:
+        if rtype == Types.MX:
+            host_names.extend(data[1] for data in datas)
+        elif rtype == Types.NS:
+            host_names.extend(datas)
+    return _addresses(names_by_key, host_names, default_ttl)
+
+
+# glue (A/AAAA records) of name servers of delegation that live in zone
+def _glue(names_by_key, ns_names, default_ttl):
+    return _join(*(_records(*result_set)
+                   for result_set in _addresses(names_by_key, ns_names, default_ttl)))
+
+
+# answer section of name for query type as result sets (owner, type, ttl, datas),
+# CNAME chain is followed while targets are in zone (at most MAX_CNAME_CHAIN
+# links, loop ends it), targets that exist only through wildcard get its
+# records (RFC 4592), rcode is the one of last name, negative tells if SOA goes
+# to authority section (NXDOMAIN/NODATA at end of chain), cut is zone cut
+# above target in child zone, its referral goes to authority section
+# returns (answer, rcode, negative, cut)
+def _chase(zone_names, existing, cuts, key_apex, key_name, qtype_code, default_ttl):
+    qtype_str = Types.reversed_types[qtype_code]
+    answer = []
+    seen = {key_name}
+    owner, name_records = zone_names[key_name]
+    while True:
+        datas, ttl = _get_records(name_records, qtype_str, default_ttl)
+        if datas:
+            answer.append((owner, qtype_code, ttl, datas))
+            return answer, ResponseCode.NO_ERROR, False, None
+        targets, ttl = _get_records(name_records, 'CNAME', default_ttl) \
+            if qtype_code != Types.CNAME else ([], 0)
+        if not targets:
+            return answer, ResponseCode.NO_ERROR, True, None
+        answer.append((owner, Types.CNAME, ttl, targets[:1]))
+        owner = targets[0]
+        key_name = owner.lower()
+        if key_name in seen or len(answer) >= MAX_CNAME_CHAIN:
+            return answer, ResponseCode.NO_ERROR, False, None
+        seen.add(key_name)
+        suffixes = name_suffixes(key_name)
+        if key_apex not in suffixes:
+            # out of zone, client follows it
+            return answer, ResponseCode.NO_ERROR, False, None
+        below_apex = suffixes[:suffixes.index(key_apex)]
+        for suffix in reversed(below_apex):
+            if suffix in cuts:
+                return answer, ResponseCode.NO_ERROR, False, suffix
+        if key_name in zone_names:
+            name_records = zone_names[key_name][1]
+            continue
+        if key_name in existing:
+            # empty non-terminal
+            return answer, ResponseCode.NO_ERROR, True, None
+        # wildcard of closest existing ancestor, target is owner of its records
+        wildcard = None
+        for suffix in below_apex[1:] + [key_apex]:
+            if suffix in existing:
+                wildcard = zone_names.get('*.' + suffix)
+                break
+        if wildcard is None:
+            return answer, ResponseCode.NAME_ERROR, True, None
+        name_records = wildcard[1]
+
+
+def _count(result_sets):
+    return sum(len(datas) for _, _, _, datas in result_sets)
+
+
+# whole response, it is truncated for udp clients when served,
+# additional records go in only if they do not make it bigger than 512 bytes
+def _build_response(name, qtype_code, rcode, answer, authority, additional):
+    builder = DNSMessageBuilder(0)
+    # flags for response and authoritive answer
+    builder.build_flags(qr=1, aa=1, rcode=rcode)
+    builder.build_head(1, _count(answer), _count(authority), _count(additional))
+    builder.build_query(name, qtype_code, 1)
+    for build, result_sets in ((builder.build_answer, answer),
+                               (builder.build_authority, authority),
+                               (builder.build_additional, additional)):
+        for owner, rtype, ttl, datas in result_sets:
+            for data in datas:
+                build(owner, rtype, 1, ttl, data)
+    response = builder.message
+    if additional and len(response) + OPT_RECORD_SIZE > MSG_SIZE:
+        return _build_response(name, qtype_code, rcode, answer, authority, [])
+    return response
+
+
+# answers of every name and type are compiled, CNAME chains inside zone
+# are followed and addresses of MX/NS targets go to additional section
+def compile_zone(zone):
+    names = zone.get_names()
+    apex = zone_apex(zone)
+    key_apex = apex.lower()
+    default_ttl = zone_default_ttl(zone)
+    soa_datas, soa_ttl = _get_records(names[apex], 'SOA', default_ttl) \
+        if apex in names else ([], 0)
+    soa = [(apex, Types.SOA, soa_ttl, soa_datas)] if soa_datas else []
+    cuts, below_cuts = _find_cuts(names, key_apex)
+    names_by_key = {name.lower(): name_records for name, name_records in names.items()}
+    # names we are authoritative for
+    zone_names = {name.lower(): (name, name_records) for name, name_records in names.items()
+                  if name not in below_cuts}
+    existing = {key_apex}
+    for key_name in zone_names:
+        for suffix in name_suffixes(key_name):
+            if suffix == key_apex or not suffix.endswith('.' + key_apex):
+                break
+            existing.add(suffix)
+    entries = {_key(NAME, key_name): b'' for key_name in existing}
+    for key_name, (name, _) in zone_names.items():
+        for qtype_code in Types.reversed_types:
+            answer, rcode, negative, cut = _chase(zone_names, existing, cuts, key_apex,
+                                                  key_name, qtype_code, default_ttl)
+            authority = soa if negative else []
+            additional = _additional(names_by_key, answer, default_ttl)
+            if cut is not None:
+                # CNAME into child zone: referral to its name servers and glue
+                ns_names, ttl = _get_records(names_by_key[cut], 'NS', default_ttl)
+                authority = [(cut, Types.NS, ttl, ns_names)]
+                additional = _addresses(names_by_key, ns_names, default_ttl) + additional
+            entries[_key(RESPONSE, key_name, qtype_code)] = _build_response(
+                name, qtype_code, rcode, answer, authority, additional)
+            if key_name.startswith('*.') and answer:
+                # first owner is written as pointer to question name
+                answer = _join(*(_records(None if index == 0 else owner, rtype, ttl, datas)
+                                 for index, (owner, rtype, ttl, datas) in enumerate(answer)))
+                authority = _join(*(_records(*result_set) for result_set in authority))
+                additional = _join(*(_records(*result_set) for result_set in additional))
+                entries[_key(WILDCARD, key_name[2:], qtype_code)] = WILDCARD_HEADER.pack(
+                    rcode, answer[1], authority[1], additional[1], len(answer[0]),
+                    len(authority[0])) + answer[0] + authority[0] + additional[0]
+        if key_name.startswith('*.'):
+            entries[_key(WILDCARD, key_name[2:])] = b''
+    for cut in cuts:
+        ns_names, ttl = _get_records(names_by_key[cut], 'NS', default_ttl)
+        ns_records = _records(cut, Types.NS, ttl, ns_names)
+        glue = _glue(names_by_key, ns_names, default_ttl)
+        entries[_key(DELEGATION, cut)] = DELEGATION_HEADER.pack(
+            ns_records[1], glue[1], len(ns_records[0])) + ns_records[0] + glue[0]
+    negative = _records(apex, Types.SOA, soa_ttl, soa_datas)
+    return ZoneData(key_apex, encode_zone(entries, negative))
+
+
+# children dict is made only for nodes that have some,
+# most nodes are zone apexes without child zones
+class _ZoneNode():
+    __slots__ = ('children', 'zone')
+
+    def __init__(self):
+        self.children = None
+        self.zone = None
+
+
+# zones in trie of reversed labels ('com' -> 'example' -> ...), lookup
+# finds zone with longest matching suffix in as many steps as name has labels
+# names of zones and queries are matched case insensitively
+# exact answers are compiled at load time, only request id is patched on lookup,
+# zone buffers are bytes or parts of mapped zone snapshot
+class ZoneIndex():
+
+    def __init__(self, zones=[]):
+        self.root = _ZoneNode()
+        self.zone_count = 0
+        self.answer_count = 0
+        for zone in zones:
+            self.add_zone(zone)
+
+    def add_zone(self, zone):
+        self.add_zone_data(compile_zone(zone))
+
+    def add_zone_data(self, zone_data):
+        node = self.root
+        for label in reversed(zone_data.apex.split('.')):
+            if label:
+                if node.children is None:
+                    node.children = {}
+                child = node.children.get(label)
+                if child is None:
+                    child = node.children[label] = _ZoneNode()
+                node = child
+        # first loaded zone wins
+        if node.zone is None:
+            node.zone = zone_data
+            self.zone_count += 1
+            self.answer_count += zone_data.responses
+
+    # zone with longest suffix of (lower cased) name, None if name is in no zone
+    def find_zone(self, key_name):
+        node = self.root
+        zone = node.zone
+        for label in reversed(key_name.split('.')):
+            if not label:
+                continue
+            node = node.children.get(label) if node.children is not None else None
+            if node is None:
+                break
+            if node.zone is not None:
+                zone = node.zone
+        return zone
+
+    # response for name from zone it belongs to: answer, NODATA/NXDOMAIN
+    # with zone SOA, wildcard answer or referral to child zone
+    # None if we are not authoritative for name
+    def lookup(self, name, qtype_code, request_id):
+        key_name = name.lower()
+        zone = self.find_zone(key_name)
+        if zone is None:
+            return None
+        return zone.answer(name, key_name, qtype_code, request_id)
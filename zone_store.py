@@ -0,0 +1,245 @@
+import mmap
+import os
+import stat as file_stat
+import threading
+import traceback
+from struct import pack, unpack_from
+from easyzone import easyzone
+from zone_index import ZoneData, ZoneIndex, compile_zone, zone_serial
+from constants import ZONE_FILE_EXT
+
+# snapshot layout (network byte order):
+#   header: magic, zone count, offset of zone buffers
+#   per zone: file name, lower cased zone name, mtime (ns), size, SOA serial,
+#             offset and length of zone buffer
+#   zone buffers (see zone_index.ZoneData) back to back
+SNAPSHOT_MAGIC = b'DNSZONE5'
+SNAPSHOT_HEADER = '!8sIQ'
+SNAPSHOT_HEADER_SIZE = 20
+SNAPSHOT_ZONE = '!QQIQQ'
+SNAPSHOT_ZONE_SIZE = 36
+
+
+def _encoded(text):
+    encoded = text.encode('utf-8')
+    return pack('!H', len(encoded)) + encoded
+
+
+def _decoded(view, index):
+    length = unpack_from('!H', view, index)[0]
+    return bytes(view[index + 2:index + 2 + length]).decode('utf-8'), index + 2 + length
+
+
+# compiled zone (ZoneData) of one zone file and state of file it was compiled from
+class CompiledZone():
+    __slots__ = ('file_name', 'mtime', 'size', 'serial', 'zone')
+
+    def __init__(self, file_name, mtime, size, serial, zone):
+        self.file_name = file_name
+        self.mtime = mtime
+        self.size = size
+        self.serial = serial
+        self.zone = zone
+
+    def matches(self, stat):
+        return (self.mtime, self.size) == (stat.st_mtime_ns, stat.st_size)
+
+
+def compile_zone_file(config_dir, file_name):
+    path = os.path.join(config_dir, file_name)
+    # stat before parsing, file changed while parsing is compiled again next time
+    stat = os.stat(path)
+    domain_name = file_name[:file_name.rfind('.')]
+    zone = easyzone.zone_from_file(domain_name, path)
+    return CompiledZone(file_name, stat.st_mtime_ns, stat.st_size,
+                        zone_serial(zone), compile_zone(zone))
+
+
+# written to temporary file and renamed, readers never see half written snapshot
+def write_snapshot(path, compiled_zones):
+    index = bytearray()
+    datas = [compiled.zone.data() for compiled in compiled_zones]
+    offset = 0
+    for compiled, data in zip(compiled_zones, datas):
+        serial = compiled.serial if compiled.serial is not None else 0xFFFFFFFF
+        index += _encoded(compiled.file_name) + _encoded(compiled.zone.apex)
+        index += pack(SNAPSHOT_ZONE, compiled.mtime, compiled.size, serial, offset, len(data))
+        offset += len(data)
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'wb') as f:
+        f.write(pack(SNAPSHOT_HEADER, SNAPSHOT_MAGIC, len(compiled_zones),
+                     SNAPSHOT_HEADER_SIZE + len(index)))
+        f.write(index)
+        for data in datas:
+            f.write(data)
+    os.replace(temporary_path, path)
+
+
+# file name: CompiledZone with zone buffer in mapped snapshot, only zone
+# headers are read, answers are searched in mapped pages when asked for,
+# pages are shared by all processes mapping same file
+# missing or broken snapshot gives empty dict (everything is compiled again)
+def read_snapshot(path):
+    try:
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return {}
+    compiled_zones = {}
+    try:
+        magic, zone_count, data_start = unpack_from(SNAPSHOT_HEADER, mapped, 0)
+        if magic != SNAPSHOT_MAGIC:
+            return {}
+        index = SNAPSHOT_HEADER_SIZE
+        for _ in range(zone_count):
+            file_name, index = _decoded(mapped, index)
+            apex, index = _decoded(mapped, index)
+            mtime, size, serial, offset, length = unpack_from(SNAPSHOT_ZONE, mapped, index)
+            index += SNAPSHOT_ZONE_SIZE
+            if data_start + offset + length > len(mapped):
+                raise ValueError('zone runs past end of snapshot')
+            zone = ZoneData(apex, mapped, data_start + offset, length)
+            compiled_zones[file_name] = CompiledZone(
+                file_name, mtime, size, serial if serial != 0xFFFFFFFF else None, zone)
+    except Exception:
+        print(f'zone snapshot {path} is broken, zones are compiled again')
+        return {}
+    return compiled_zones
+
+
+# zone files of config dir compiled into ZoneIndex, backed by snapshot
+# reload compiles only files whose mtime or size changed and swaps in
+# new index, lookups running on old one finish with it
+# file that fails to compile keeps its previous answers, other zones load
+class ZoneStore():
+
+    def __init__(self, config_dir, snapshot_path=None):
+        self.config_dir = config_dir
+        self.snapshot_path = snapshot_path
+        self.compiled = {}  # file name: CompiledZone
+        # file name: (mtime, size) of version that failed to compile
+        self.failed = {}
+        self.index = ZoneIndex()
+        # called with new index after reload
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.reload_requested = threading.Event()
+
+    def _zone_files(self):
+        try:
+            file_names = os.listdir(self.config_dir)
+        except OSError:
+            print(f'error ocuured while reading zone files in dir : {self.config_dir}')
+            traceback.print_exc()
+            return {}
+        stats = {}
+        for file_name in sorted(file_names):
+            if file_name.find(ZONE_FILE_EXT) == -1:
+                continue
+            try:
+                stat = os.stat(os.path.join(self.config_dir, file_name))
+            except OSError:
+                continue
+            if file_stat.S_ISREG(stat.st_mode):
+                stats[file_name] = stat
+        return stats
+
+    def _is_current(self, file_name, stat):
+        compiled = self.compiled.get(file_name)
+        if compiled is not None and compiled.matches(stat):
+            return True
+        return self.failed.get(file_name) == (stat.st_mtime_ns, stat.st_size)
+
+    # some zone file was added, removed or modified since last load
+    def has_changes(self):
+        stats = self._zone_files()
+        if stats.keys() != self.compiled.keys() | self.failed.keys():
+            return True
+        return not all(self._is_current(file_name, stat) for file_name, stat in stats.items())
+
+    # compile file, on error keep previous version and remember failed one
+    def _compile(self, file_name, previous, version):
+        try:
+            compiled = compile_zone_file(self.config_dir, file_name)
+        except Exception:
+            keeping = 'keeping previous version' if previous else 'zone skipped'
+            print(f'error ocuured while reading zone file {file_name}, {keeping}')
+            traceback.print_exc()
+            self.failed[file_name] = version
+            return previous
+        self.failed.pop(file_name, None)
+        # touched or copied file compiles to same zone, only real changes
+        # without serial increment are worth a warning
+        if previous is not None and compiled.serial == previous.serial and \
+                compiled.zone.data() != previous.zone.data():
+            print(f'zone file {file_name} changed but SOA serial {compiled.serial} did not')
+        return compiled
+
+    # compile changed zone files, returns current index
+    def load(self):
+        with self.lock:
+            previous = self.compiled
+            if not previous and self.snapshot_path:
+                previous = read_snapshot(self.snapshot_path)
+            stats = self._zone_files()
+            compiled_zones = {}
+            recompiled = False
+            for file_name, stat in stats.items():
+                compiled = previous.get(file_name)
+                version = (stat.st_mtime_ns, stat.st_size)
+                if (compiled is None or not compiled.matches(stat)) and \
+                        self.failed.get(file_name) != version:
+                    recompiled = True
+                    compiled = self._compile(file_name, compiled, version)
+                if compiled is not None:
+                    compiled_zones[file_name] = compiled
+            self.failed = {file_name: version for file_name, version in self.failed.items()
+                           if file_name in stats}
+            if self.snapshot_path and (recompiled or compiled_zones.keys() != previous.keys()):
+                try:
+                    write_snapshot(self.snapshot_path, list(compiled_zones.values()))
+                except OSError as error:
+                    print(f'zone snapshot {self.snapshot_path} not written: {error}')
+                else:
+                    # zones are served from mapped file, pages shared by workers
+                    # and not private memory of process
+                    compiled_zones = read_snapshot(self.snapshot_path) or compiled_zones
+            changed = compiled_zones.keys() != self.compiled.keys() or any(
+                self.compiled.get(file_name) is not compiled
+                for file_name, compiled in compiled_zones.items())
+            if changed:
+                index = ZoneIndex()
+                for compiled in compiled_zones.values():
+                    index.add_zone_data(compiled.zone)
+                self.compiled = compiled_zones
+                self.index = index
+            return self.index
+
+    def reload(self):
+        index = self.index
+        new_index = self.load()
+        if new_index is not index:
+            for listener in self.listeners:
+                listener(new_index)
+        return new_index
+
+    # safe to call from signal handler, reload runs in watcher thread
+    def request_reload(self):
+        self.reload_requested.set()
+
+    # background thread reloading on request_reload (SIGHUP) and,
+    # if interval is given, when zone files change (polled every interval seconds)
+    def start_watcher(self, interval=None):
+        thread = threading.Thread(target=self._watch, args=(interval,), daemon=True)
+        thread.start()
+        return thread
+
+    def _watch(self, interval):
+        while True:
+            requested = self.reload_requested.wait(interval)
+            self.reload_requested.clear()
+            try:
+                if requested or self.has_changes():
+                    self.reload()
+            except Exception:
+                traceback.print_exc()